@@ -1,14 +1,21 @@
 import inspect
-from django.contrib.admin.views.main import ChangeList as ChangeListDefault
+from django.contrib.admin.views.main import ChangeList as ChangeListDefault, ORDER_VAR, PAGE_VAR
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.core.paginator import Paginator
+from django.utils.functional import cached_property
 from django.urls import reverse
 from django.db.models import *
-from django.contrib import admin
+from django.contrib import admin, messages
 from django.db.models import Max, Prefetch, F, FilteredRelation, Value, Q, F, OuterRef
 from django.contrib.auth.models import User
 from django.db import connection
-from django.utils.html import escape, format_html
+from django.utils.html import escape, format_html, format_html_join
+from django.utils.safestring import mark_safe
 from django.contrib.postgres.search import SearchVector, SearchRank, SearchQuery, TrigramSimilarity
+from django.db.models.functions import Coalesce, Left
 from . import models, settings
+from .query import parse_query, parse_date, QueryError
+from .search import match_addresses, address_ids, search_emails, add_headlines, collapse_threads, count_results, cached_results, normalize_search_term, headline_start, headline_stop
 from enum import Enum
 from datetime import datetime
 
@@ -21,7 +28,7 @@ def get_id_fields(obj) -> list:
     return [e.name for e in obj._meta.get_fields() if type(e) in [models.ManyToManyField, models.ForeignKey]]
 
 for name, obj in {name: obj for (name, obj) in inspect.getmembers(models)}.items():
-    if inspect.isclass(obj) and not obj is Model and issubclass(obj, Model) and name not in ['Email', 'IndexEntry', 'EmailAttachment']:
+    if inspect.isclass(obj) and not obj is Model and issubclass(obj, Model) and name not in ['Email', 'EmailAddress', 'IndexEntry', 'EmailAttachment', 'IndexedFile', 'IndexGeneration', 'ThreadReference', 'EmailBodyChunk']:
         class AdminClass(admin.ModelAdmin):
             raw_id_fields = get_id_fields(obj)
             search_fields = get_search_fields(obj)
@@ -51,6 +58,9 @@ def highlight_search_term(content: str, search_term: str, max_size: int, link: s
     else:
         return format_html('{}<b>{}</b>{}', prefix, content[match_position:match_position + len(search_term)], suffix)
 
+def render_headline(headline: str):
+    return mark_safe(escape(headline).replace(headline_start, '<b>').replace(headline_stop, '</b>'))
+
 def make_multiline_html(text: str):
     return format_html(escape(text).replace('\n', '<br/>').replace('{', '{{').replace('}', '}}'))
 
@@ -63,15 +73,96 @@ def make_link(entry, text: str):
 def make_list_link(entries, text_method) -> str:
     return format_html(', '.join(f'<a href="{e.admin_link()}">{escape(text_method(e))} </a>' for e in entries))
 
+def hidden_params(changelist, exclude: list) -> list:
+    # Current parameters (search, other filters) that input filters need to submit along with their own
+    params = []
+    for name, values in changelist.params.items():
+        if name not in exclude and name != PAGE_VAR:
+            params += [(name, value) for value in (values if isinstance(values, list) else [values])]
+
+    return params
+
+class InputFilter(admin.SimpleListFilter):
+    template = 'admin_input_filter.html'
+    autocomplete_url = None
+
+    def lookups(self, request, model_admin):
+        return ((None, None),)
+
+    def choices(self, changelist):
+        all_choice = next(super().choices(changelist))
+        all_choice['hidden_params'] = hidden_params(changelist, [self.parameter_name])
+        yield all_choice
+
+class DateRangeFilter(admin.ListFilter):
+    # Emails sent between two dates (inclusive). Served by the date index
+    title = 'date'
+    template = 'admin_date_range_filter.html'
+    parameters = ['after', 'before']
+
+    def __init__(self, request, params, model, model_admin):
+        super().__init__(request, params, model, model_admin)
+
+        self.used_parameters = {}
+        for name in self.parameters:
+            if name in params:
+                value = params.pop(name)
+                self.used_parameters[name] = value[-1] if isinstance(value, list) else value
+
+    def has_output(self):
+        return True
+
+    def expected_parameters(self):
+        return self.parameters
+
+    def choices(self, changelist):
+        yield {'selected': not self.used_parameters,
+               'query_string': changelist.get_query_string(remove=self.parameters),
+               'hidden_params': hidden_params(changelist, self.parameters),
+               'after': self.used_parameters.get('after', ''),
+               'before': self.used_parameters.get('before', ''),
+               'display': 'All'}
+
+    def queryset(self, request, queryset):
+        after = self.used_parameters.get('after')
+        before = self.used_parameters.get('before')
+
+        try:
+            if after:
+                queryset = queryset.filter(date__gte=parse_date(after))
+            if before:
+                queryset = queryset.filter(date__lte=parse_date(before))
+        except QueryError as e:
+            raise IncorrectLookupParameters(str(e))
+
+        return queryset
+
+class EstimatedCountPaginator(Paginator):
+    count_limit = settings.SEARCH_RESULT_COUNT_LIMIT
+
+    @cached_property
+    def count(self):
+        return count_results(self.object_list, self.count_limit)
+
 
 class EmailAttachment(admin.ModelAdmin):
     raw_id_fields = get_id_fields(models.EmailAttachment)
 
-    readonly_fields = ('source_email', 'file_name', 'content_type', 'download')
+    readonly_fields = ('source_email', 'file_name', 'content_type', 'text_status', 'download')
 
     def download(self, entry):
         return format_html(f'<a href="{entry.download_link()}">{escape(entry.file_name or "unnamed")} </a>')
 
+class EmailAddress(admin.ModelAdmin):
+    search_fields = ['address'] # Only shows the search box, see get_search_results()
+
+    def get_search_results(self, request, queryset, search_term):
+        search_term = normalize_search_term(search_term)
+        if not search_term:
+            return queryset, False
+
+        return match_addresses(queryset, search_term), False
+
 class Email(admin.ModelAdmin):
     class FuzzyFilter(admin.SimpleListFilter):
         title = 'Fuzzy search'
@@ -89,25 +180,31 @@ class Email(admin.ModelAdmin):
                 request.environ['fuzzy_search' ] = True
                 return queryset
 
-    class AddressFilter(admin.SimpleListFilter):
-        title = 'author'
-        parameter_name = 'address'
-        template = 'admin_input_filter.html'
+    class ThreadFilter(admin.SimpleListFilter):
+        title = 'Threads'
+        parameter_name = 'threads'
 
         def lookups(self, request, model_admin):
-            return ((None, None),)
+            return [('collapse', 'collapse by thread')]
+
+        def queryset(self, request, queryset):
+            value = self.value()
+
+            if value is None:
+                return queryset
+            else:
+                request.environ['collapse_threads'] = True # Applied after searching, see get_search_results()
+                return queryset
 
-        def choices(self, changelist):
-            query_params = changelist.get_filters_params()
-            query_params.pop(self.parameter_name, None)
-            all_choice = next(super().choices(changelist))
-            all_choice['query_params'] = query_params
-            yield all_choice
+    class AddressFilter(InputFilter):
+        title = 'author'
+        parameter_name = 'address'
+        autocomplete_url = '/autocomplete/address/'
 
         def queryset(self, request, queryset):
             value = self.value()
             if value:
-                return queryset.filter(author__address__trigram_similar=value)
+                return queryset.filter(author_id__in=address_ids(value))
 
     class AttachmentFilter(admin.SimpleListFilter):
         title = 'Attachments'
@@ -122,19 +219,103 @@ class Email(admin.ModelAdmin):
             if value is None:
                 return queryset
             else:
-                attachment_query = models.EmailAttachment.objects.filter(source_email=OuterRef('pk'))
-                return queryset.annotate(attachment=Exists(attachment_query)).filter(attachment=True)
+                return queryset.filter(attachment_count__gt=0) # Served by the partial with_attachment_index
 
 
-    list_filter = [FuzzyFilter, AttachmentFilter, AddressFilter]
+    list_filter = [FuzzyFilter, ThreadFilter, DateRangeFilter, AttachmentFilter, AddressFilter]
     raw_id_fields = get_id_fields(models.Email)
     search_fields = ['id']
 
     list_display = ('_rank', '_subject', '_author', 'content_list')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False # Would count the whole table on every page
 
-    readonly_fields = ('subject', 'date', '_from', 'message_id', '_in_reply_to', 'date', '_to', '_cc', 'content', 'attachments', '_indexing_log', 'original_path')
+    readonly_fields = ('subject', 'date', '_from', 'message_id', '_in_reply_to', '_thread', 'date', '_to', '_cc', 'content', 'attachments', '_headers', '_indexing_log', 'original_path')
     #link_fields = ('latest', )
 
+    def get_changelist(self, request, **kwargs):
+        cursor_var = 'cursor'
+
+        # Results are paginated by (rank, id) when searching, by id otherwise.
+        # This follows the default ordering, so OFFSET pagination is only used when another ordering is selected.
+        class ChangeList(ChangeListDefault):
+            def __init__(self, request, *args, **kwargs):
+                # Like the page number, the cursor isn't a filter
+                self.cursor = request.GET.get(cursor_var)
+                if self.cursor is not None:
+                    request.GET = request.GET.copy()
+                    del request.GET[cursor_var]
+
+                super().__init__(request, *args, **kwargs)
+
+            def make_cursor(self, entry) -> str:
+                return f'{entry.rank!r}:{entry.id}' if self.text_search_term else str(entry.id)
+
+            def cursor_filter(self) -> Q:
+                try:
+                    if self.text_search_term:
+                        rank, id = self.cursor.split(':')
+                        return Q(rank__lt=float(rank)) | Q(rank=float(rank), id__lt=int(id))
+                    else:
+                        return Q(id__lt=int(self.cursor))
+                except ValueError:
+                    raise IncorrectLookupParameters(f'Invalid cursor: {self.cursor}')
+
+            def set_headlines(self, results: list):
+                if self.text_search_term and results:
+                    add_headlines(results, self.text_search_term)
+
+            def get_results(self, request):
+                # Part of the search that's ranked by the text index, set by get_search_results() when the queryset is built
+                self.text_search_term = request.environ.get('text_search_term')
+
+                self.first_page_url = self.get_query_string() if self.cursor is not None else None
+                self.next_page_url = None
+
+                if ORDER_VAR in self.params:
+                    super().get_results(request)
+                    self.result_list = list(self.result_list)
+                    self.set_headlines(self.result_list)
+                    return
+
+                queryset = self.queryset
+                if self.cursor is not None:
+                    queryset = queryset.filter(self.cursor_filter())
+
+                # Fetch one more entry to know if there's a next page
+                results = cached_results(queryset, self.list_per_page + 1)
+                if len(results) > self.list_per_page:
+                    results = results[:self.list_per_page]
+                    self.next_page_url = self.get_query_string({cursor_var: self.make_cursor(results[-1])})
+
+                self.set_headlines(results)
+                self.paginator = self.model_admin.get_paginator(request, self.queryset, self.list_per_page)
+                self.result_count = self.paginator.count
+                self.full_result_count = None
+                self.show_full_result_count = False
+                self.show_admin_actions = True
+                self.result_list = results
+                self.can_show_all = False
+                self.multi_page = False # Pages are linked by cursor, see pagination.html
+
+        return ChangeList
+
+    def changelist_view(self, request, extra_context=None):
+        request.environ['changelist'] = True # Only load what the results page displays, see get_queryset()
+        return super().changelist_view(request, extra_context)
+
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+
+        if request.environ.get('changelist', False):
+            queryset = queryset.select_related('author').defer('content_text', 'content_html', 'indexing_log', 'search_vector', 'author__indexing_log')
+
+        return queryset
+
+    def content_snippet(self):
+        # Only fetch the part of the body that's displayed in the results page. Search results are highlighted separately, see add_headlines()
+        return Left(Coalesce('content_text', 'content_html'), settings.RESULT_PAGE_MAX_EMAIL_BODY_SIZE)
+
     def _from(self, entry):
         return make_link(entry.author, entry.author.to_string())
 
@@ -149,20 +330,32 @@ class Email(admin.ModelAdmin):
 
     def _subject(self, entry):
         value = entry.subject
-        if hasattr(entry, 'search_term') and entry.search_term:
+        if getattr(entry, 'subject_headline', None):
+            return format_html('<a href="{}">{}</a>', entry.admin_link(), render_headline(entry.subject_headline))
+        elif hasattr(entry, 'search_term') and entry.search_term:
             return highlight_search_term(value, entry.search_term, settings.RESULT_PAGE_MAX_EMAIL_SUJECT_SIZE, link=entry.admin_link())
         else:
             return format_html(f'<a href="/searchix/email/{entry.id}/change"> {entry.subject} </a>')
 
     def content_list(self, entry):
-        value = entry.content_text or entry.content_html or '<null>'
+        if getattr(entry, 'content_headline', None):
+            return render_headline(entry.content_headline)
+        elif hasattr(entry, 'content_snippet'):
+            value = entry.content_snippet or '<null>'
+        else:
+            value = entry.content_text or entry.content_html or '<null>'
+
         if hasattr(entry, 'search_term') and entry.search_term:
             return highlight_search_term(value, entry.search_term, settings.RESULT_PAGE_MAX_EMAIL_BODY_SIZE)
         else:
             return value[:settings.RESULT_PAGE_MAX_EMAIL_BODY_SIZE]
 
     def content(self, entry):
-        value = entry.content_text or entry.content_html or '<null>'
+        if entry.content_text is not None:
+            value = entry.content_text + ''.join(entry.body_chunks.order_by('position').values_list('content', flat=True))
+        else:
+            value = entry.content_html or '<null>'
+
         return make_multiline_html(value)
 
     def _author(self, entry):
@@ -184,20 +377,50 @@ class Email(admin.ModelAdmin):
         if entry.in_reply_to is None:
             return None
 
-        matches = models.Email.objects.filter(message_id=entry.in_reply_to)
-        if matches.count() == 0:
+        parent = models.Email.objects.filter(message_id=entry.in_reply_to).only('id').first()
+        if parent is None:
             return f'Not found: {entry.in_reply_to}'
-        elif matches.count() == 1:
-            return make_link(matches[0], entry.in_reply_to)
         else:
-            return format_html('Found multiple: ' + ','.join(make_link(e, e.id) for e in matches))
+            return make_link(parent, entry.in_reply_to)
+
+    def _thread(self, entry):
+        if entry.thread_id is None:
+            return None
+
+        max_size = settings.THREAD_VIEW_MAX_SIZE
+        emails = list(models.Email.objects.filter(thread_id=entry.thread_id).order_by('date', 'id').only('id', 'subject', 'date')[:max_size + 1])
+
+        links = format_html_join(format_html('<br/>'), '<a href="{}">{} {}</a>', ((e.admin_link(), e.date or '', e.subject or '<no subject>') for e in emails[:max_size]))
+        if len(emails) > max_size:
+            return format_html('{}<br/><a href="{}">Show the whole thread</a>', links, entry.thread_link())
+        else:
+            return links
+
+    def _headers(self, entry):
+        if entry.headers is None:
+            return None
+
+        return format_html_join(format_html('<br/>'), '<b>{}</b>: {}', ((name, value) for name, values in entry.headers.items() for value in values))
 
     def attachments(self, entry):
         attachments = models.EmailAttachment.objects.filter(source_email=entry).all()
         return format_html(', '.join(f'<a href="{e.download_link()}">{escape(e.file_name or "unnamed")} </a> <a href="{e.admin_link()}">(object)</a>' for e in attachments))
 
     def get_search_results(self, request, queryset, search_term):
+        try:
+            search_term, condition = parse_query(normalize_search_term(search_term))
+        except QueryError as e:
+            raise IncorrectLookupParameters(str(e))
+
+        queryset = queryset.filter(condition)
+
+        if request.environ.get('changelist', False):
+            queryset = queryset.annotate(content_snippet=self.content_snippet())
+
         if not search_term:
+            if request.environ.get('collapse_threads', False):
+                queryset = collapse_threads(queryset, ['-id'])
+
             return queryset, False
 
         if False: # sqlite
@@ -206,29 +429,26 @@ class Email(admin.ModelAdmin):
                     Q(content_text__icontains=search_term) |
                     Q(content_html__icontains=search_term)).annotate(search_term=Value(search_term)), False
         else:
-            query = SearchQuery(search_term, search_type='websearch')
-
-            search_vectors = (SearchVector('subject', weight='A', config='english')
-                              + SearchVector('content_text', weight='B', config='english')
-                              + SearchVector('content_html', weight='C', config='english'))
+            truncated = []
+            query = search_emails(queryset, search_term, fuzzy=request.environ.get('fuzzy_search', False), truncated=truncated)
+            for model, limit in truncated:
+                messages.warning(request, f'Too many matches in {model._meta.verbose_name_plural}: only the best {limit} are included in the results')
 
-            rank = SearchRank(search_vectors, query=query)
+            query = query.annotate(search_term=Value(search_term))
+            request.environ['text_search_term'] = search_term
 
-            # Search the text index first
-            query = queryset.filter(search=query).annotate(rank=rank).annotate(search_term=Value(search_term))
+            if request.environ.get('collapse_threads', False):
+                query = collapse_threads(query, ['-rank', '-id'])
 
-            # Then add trigrams if requested
-            if request.environ.get('fuzzy_search', False):
-                trigrams = TrigramSimilarity('subject', search_term) + TrigramSimilarity('content_text', search_term) + TrigramSimilarity('content_html', search_term)
-                augmented_query = query.union(self.model.objects.exclude(id__in=query.values_list('id', flat=True)).annotate(rank=trigrams - 1).filter(rank__gte=-0.9).annotate(search_term=Value(search_term)))
-                query = augmented_query
-
-            return query.order_by('-rank'),False
+            return query.order_by('-rank', '-id'),False
 
 admin.site.register(models.Email, Email)
 admin.site.register(models.EmailAttachment, EmailAttachment)
+admin.site.register(models.EmailAddress, EmailAddress)
 
 class IndexEntry(admin.ModelAdmin):
+    list_filter = [('created_timestamp', admin.DateFieldListFilter)] # Served by the created_timestamp BRIN index
+
     def get_changelist(self, request, **kwargs):
         class ChangeList(ChangeListDefault):
             def url_for_result(self, result):
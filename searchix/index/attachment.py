@@ -0,0 +1,137 @@
+from searchix.models import *
+from searchix import settings
+from searchix.index.email import decode_bytes, decode_payload, extract_text_from_html
+
+import email
+import email.header
+import functools
+import logging
+import multiprocessing
+import os
+import traceback
+import django
+from django.db import transaction, connections
+
+logger = logging.Logger(__name__)
+
+# Used when attachments are sent as application/octet-stream
+extension_types = {'.txt': 'text/plain',
+                   '.csv': 'text/csv',
+                   '.htm': 'text/html',
+                   '.html': 'text/html',
+                   '.eml': 'message/rfc822'}
+
+
+def extract_plain_text(content: bytes) -> str:
+    return decode_bytes(content, None)
+
+def extract_html(content: bytes) -> str:
+    return extract_text_from_html(decode_bytes(content, None))
+
+def extract_email(content: bytes) -> str:
+    message = email.message_from_bytes(content)
+
+    parts = []
+    for header in ['Subject', 'From', 'To']:
+        if message.get(header):
+            parts.append(str(email.header.make_header(email.header.decode_header(message[header]))))
+
+    for part in message.walk():
+        # Attachments of the attached email aren't extracted
+        if part.get_content_disposition() == 'attachment':
+            continue
+        elif part.get_content_type() == 'text/plain':
+            parts.append(decode_payload(part))
+        elif part.get_content_type() == 'text/html':
+            parts.append(extract_text_from_html(decode_payload(part)))
+
+    return '\n'.join(parts)
+
+extractors = {'text/plain': extract_plain_text,
+              'text/csv': extract_plain_text,
+              'text/html': extract_html,
+              'message/rfc822': extract_email}
+
+def get_extractor(attachment: EmailAttachment):
+    content_type = (attachment.content_type or '').lower()
+    if content_type not in extractors:
+        content_type = extension_types.get(os.path.splitext(attachment.file_name or '')[1].lower())
+
+    return extractors.get(content_type)
+
+def read_content(attachment: EmailAttachment) -> bytes:
+    # Returns None if the attachment is too big to be extracted
+    with attachment.open_content() as fd:
+        content = fd.read(settings.ATTACHMENT_EXTRACT_MAX_SIZE + 1)
+
+    return content if len(content) <= settings.ATTACHMENT_EXTRACT_MAX_SIZE else None
+
+def extract_attachment(attachment: EmailAttachment):
+    extractor = get_extractor(attachment)
+    if extractor is None:
+        attachment.text_status = EmailAttachment.TextStatus.Unsupported
+        return
+
+    try:
+        content = read_content(attachment)
+        if content is None:
+            attachment.text_status = EmailAttachment.TextStatus.Unsupported
+            attachment.add_indexing_note(f'Attachment is too big to extract its text')
+            return
+
+        # postgres doesn't accept null bytes in strings, and tsvectors are limited to 1MB
+        text = extractor(content).replace('\x00', '\uFFFD')[:settings.ATTACHMENT_TEXT_MAX_SIZE]
+    except:
+        message = f'Failed to extract text from attachment {attachment.id}: {traceback.format_exc()}'
+        logger.warning(message)
+
+        attachment.text_status = EmailAttachment.TextStatus.Failed
+        attachment.add_indexing_note(message)
+        return
+
+    attachment.text_status = EmailAttachment.TextStatus.Extracted
+    attachment.search_vector = EmailAttachment.search_vector_expression(Value(text, output_field=TextField()))
+
+def extract_batch(batch_size: int) -> int:
+    # Returns the number of processed attachments, 0 once there are no pending attachments left
+    with transaction.atomic():
+        # Attachments claimed by other workers are skipped, so that workers don't wait on each other
+        batch = list(EmailAttachment.objects.select_for_update(skip_locked=True, of=('self',))
+                                            .filter(text_status=EmailAttachment.TextStatus.Pending)
+                                            .select_related('blob')
+                                            .order_by('pk')[:batch_size])
+        if not batch:
+            return 0
+
+        for attachment in batch:
+            extract_attachment(attachment)
+
+        EmailAttachment.objects.bulk_update(batch, ['text_status', 'search_vector', 'indexing_log'])
+
+        if any(e.text_status == EmailAttachment.TextStatus.Extracted for e in batch):
+            IndexGeneration.bump()
+
+    return len(batch)
+
+def extract_pending(batch_size: int) -> int:
+    processed = 0
+    while (batch_processed := extract_batch(batch_size)) > 0:
+        processed += batch_processed
+        logger.debug(f'Processed {processed} attachments')
+
+    return processed
+
+def init_worker():
+    # Only needed when the 'spawn' start method is used. Database connections are opened lazily by each worker
+    django.setup()
+
+def extract_worker(_, batch_size: int) -> int:
+    return extract_pending(batch_size)
+
+def extract_pending_parallel(workers: int, batch_size: int) -> int:
+    # Don't share the parent's database connection with the worker processes
+    connections.close_all()
+
+    worker = functools.partial(extract_worker, batch_size=batch_size)
+    with multiprocessing.Pool(workers, initializer=init_worker) as pool:
+        return sum(pool.map(worker, range(workers)))
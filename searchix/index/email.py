@@ -1,50 +1,151 @@
 from searchix.models import *
 from searchix import settings
+from searchix.index.manifest import Manifest, hash_content
+from searchix.index.mbox import read_mbox
+from searchix.index.thread import parse_references, insert_references, assign_threads
+from searchix.storage import get_storage, store_attachments
 
 import email
 import traceback
 import os
 import dateutil
+from collections import OrderedDict
 from email.utils import parseaddr, getaddresses, parsedate_to_datetime
-from django.db import transaction
-from django.db.utils import OperationalError
+from django.db import transaction, connections
+from django.db.models.functions import Coalesce, Concat, Length, Lower, StrIndex
+from django.db.utils import OperationalError, IntegrityError
 from psycopg2.errors import ProgramLimitExceeded
 
 import email.header
+import email.message
+import functools
+import html
+import io
 import logging
+import multiprocessing
+import queue
 import re
+import threading
+import django
 from html2text import HTML2Text
 
 logger = logging.Logger(__name__)
 
+html_pattern = re.compile(r'<(html|head|meta|img)', re.IGNORECASE)
+structured_html_pattern = re.compile(r'<(table|ul|ol|pre|blockquote|h[1-6])\b', re.IGNORECASE)
+image_pattern = re.compile(r'<img\b[^>]*>', re.IGNORECASE)
+comment_pattern = re.compile(r'<!--.*?-->', re.DOTALL)
+invisible_pattern = re.compile(r'<(head|script|style)\b.*?</\1\s*>', re.IGNORECASE | re.DOTALL)
+line_break_pattern = re.compile(r'<(br|/p|/div|/tr|/li)\b[^>]*>', re.IGNORECASE)
+tag_pattern = re.compile(r'<[^>]*>')
+blank_pattern = re.compile(r'[^\S\n]+')
+empty_lines_pattern = re.compile(r'\s*\n\s*')
+surrogate_pattern = re.compile('[\ud800-\udfff]')
+
+html_converter_options = {'ignore_images': True,
+                          'ignore_links': True,
+                          'ignore_emphasis': True,
+                          'ignore_tables': True,
+                          'single_line_break': True,
+                          'wrap_links': True,
+                          'wrap_lists': True}
+
 
 def get_or_create_address(value: str) -> EmailAddress:
     name, address = parseaddr(value)
     return get_or_create_address_impl(name, address)
 
+class AddressCache:
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries = OrderedDict() # Lowercase address -> EmailAddress, in LRU order
+        self.pending_names = {}
+
+    def preload(self):
+        self.entries.clear()
+        for entry in EmailAddress.objects.only('id', 'address', 'display_names').order_by('-id')[:self.max_size].iterator():
+            self.entries.setdefault(entry.address.lower(), entry)
+
+        logger.debug(f'Preloaded {len(self.entries)} email addresses')
+
+    def get(self, address: str) -> EmailAddress:
+        entry = self.entries.get(address.lower())
+        if entry is not None:
+            self.entries.move_to_end(address.lower())
+
+        return entry
+
+    def add(self, entry: EmailAddress):
+        self.entries[entry.address.lower()] = entry
+        self.entries.move_to_end(entry.address.lower())
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def update_names(self, entry: EmailAddress, name: str):
+        # Display names are written back in batches, see flush()
+        names = self.pending_names.setdefault(entry.id, [])
+        if name not in names:
+            names.append(name)
+
+    def flush(self):
+        # Names are appended in SQL, since other indexing processes might have added names to the same address since it was cached
+        for address_id, names in self.pending_names.items():
+            for name in names:
+                append_name(address_id, name)
+
+        self.pending_names = {}
+
+def append_name(address_id: int, name: str):
+    # Only if the name isn't already listed, and still fits in the column
+    names = Coalesce('display_names', Value(''))
+
+    (EmailAddress.objects.filter(id=address_id)
+                         .alias(name_position=StrIndex(Concat(Value(','), names, Value(',')), Value(f',{name},')), names_length=Length(names))
+                         .filter(name_position=0, names_length__lte=1024 - len(name) - 1)
+                         .update(display_names=Case(When(Q(display_names=None) | Q(display_names=''), then=Value(name)), default=Concat('display_names', Value(f',{name}')))))
+
+address_cache = AddressCache(settings.ADDRESS_CACHE_SIZE)
+
+def find_address(address: str) -> EmailAddress:
+    return EmailAddress.objects.alias(lower_address=Lower('address')).filter(lower_address=address.lower()).order_by('id').first()
+
 def get_or_create_address_impl(name: str, address: str) -> EmailAddress:
     if name is not None and ',' in name:
         logger.warning(f'Found comma in name "{name}" for email: {address}')
         name = name.replace(',', '')
 
-    try:
-        entry = EmailAddress.objects.get(address__iexact=address.lower())
-    except EmailAddress.DoesNotExist:
-        entry = EmailAddress(display_names=name if name else None, address=address)
-        entry.save()
-        logger.debug(f'Creating new entry for email address: {address}. id={entry.id}')
-        return entry
+    entry = address_cache.get(address)
+    if entry is None:
+        entry = find_address(address)
+
+        if entry is None:
+            entry = EmailAddress(display_names=name if name else None, address=address)
+            try:
+                with transaction.atomic():
+                    entry.save()
+            except IntegrityError:
+                # Another indexing process created this address concurrently
+                return find_address(address)
+
+            # Only cache the new entry once it's committed, since the transaction might still be rolled back
+            transaction.on_commit(lambda: address_cache.add(entry))
+            logger.debug(f'Creating new entry for email address: {address}. id={entry.id}')
+            return entry
+
+        address_cache.add(entry)
 
     if name and name not in entry.names():
-        entry.display_names = ','.join(entry.names() + [name])
+        display_names = ','.join(entry.names() + [name])
 
-        if len(entry.display_names) > 1024:
+        if len(display_names) > 1024:
             logger.warning(f'Dropping name "{name}" from address {address}. Maximum size reached')
             return entry
         else:
             logger.debug(f'Added name: "{name}" to email address: {entry}')
 
-        entry.save()
+        entry.display_names = display_names
+        address_cache.update_names(entry, name)
 
     return entry
 
@@ -60,18 +161,38 @@ def utf8_decode(value: bytes) -> str:
     # postgres doesn't accept null bytes in strings
     return value.decode('utf8', errors='replace').replace("\x00", "\uFFFD")
 
+def decode_bytes(value: bytes, charset: str) -> str:
+    if charset is not None and charset.lower() not in ['us-ascii', 'ascii', 'utf-8', 'utf8']: # 8bit utf8 content is often mislabeled as ascii
+        try:
+            return value.decode(charset, errors='replace').replace("\x00", "\uFFFD")
+        except LookupError:
+            pass # Unknown charset
+
+    return utf8_decode(value)
+
+def decode_payload(part) -> str:
+    return decode_bytes(part.get_payload(decode=True) or b'', part.get_content_charset())
+
+def get_attachment_payload(part) -> bytes:
+    if part.is_multipart():
+        # Attached emails (message/rfc822) are stored as parsed sub-messages
+        return b''.join(e.as_bytes() for e in part.get_payload())
+    else:
+        return part.get_payload(decode=True)
+
 def decode_header(header: str, entry: Email, max_size: int) -> str:
     if header is None:
         return None
 
-    def decode_value(value) -> str:
+    def decode_value(value, charset: str) -> str:
         if isinstance(value, bytes):
             # remove any BOM header found
-            return utf8_decode(value)
+            return decode_bytes(value, charset)
         else:
-            return value
+            # ASCII header values aren't decoded, postgres doesn't accept null bytes in strings
+            return value.replace("\x00", "\uFFFD")
     try:
-        decoded = [decode_value(value) for value, _ in email.header.decode_header(header)]
+        decoded = [decode_value(value, charset) for value, charset in email.header.decode_header(header)]
         result = ''.join(decoded)
 
         if max_size is not None and len(result) > max_size:
@@ -109,54 +230,107 @@ def decode_date(value: str, entry: Email) -> datetime:
             return None
 
 
-def extract_text_from_html(content: str):
-    convert = HTML2Text()
-    convert.ignore_images = True
-    convert.ignore_links = True
-    convert.ignore_emphasis = True
-    convert.ignore_tables = True
-    convert.single_line_break = True
-    convert.wrap_links = True
-    convert.wrap_lists = True
+def make_html_converter() -> HTML2Text:
+    # HTML2Text keeps the parser state of the previous document, so a new converter is needed for each conversion
+    converter = HTML2Text()
+    converter.__dict__.update(html_converter_options)
+
+    return converter
+
+def strip_html(content: str) -> str:
+    # Fast path: only keeps the text and line breaks, which is enough for indexing
+    content = comment_pattern.sub('', content)
+    content = invisible_pattern.sub('', content)
+    content = line_break_pattern.sub('\n', content)
+    content = html.unescape(tag_pattern.sub(' ', content))
+    content = blank_pattern.sub(' ', content)
+
+    return empty_lines_pattern.sub('\n', content).strip()
 
-    extracted = convert.handle(re.sub('<img .*?>', 'removed-image', content)) # Remove potential images
+def is_simple_html(content: str) -> bool:
+    # Without tables, lists or blocks, the converter's output only differs from strip_html() by whitespace
+    return structured_html_pattern.search(content) is None
+
+def extract_text_from_html(content: str):
+    if len(content) > settings.HTML_CONVERSION_MAX_SIZE or is_simple_html(content):
+        extracted = strip_html(content)
+    else:
+        extracted = make_html_converter().handle(image_pattern.sub('', content))
 
     # Note: re-encoding needed because surrogates will break the sql statement
-    return extracted.encode(errors='replace').decode(errors='replace')
+    if surrogate_pattern.search(extracted):
+        extracted = extracted.encode(errors='replace').decode(errors='replace')
+
+    return extracted
 
 
 def process_text_content(content: str):
     # Try to guess if content is html
-    if any(e in content.casefold() for e in ['<html', '<head', '<meta', '<img']):
+    if html_pattern.search(content):
         return extract_text_from_html(content)
     else:
         return content
 
-def reduce_body_size(content: str) -> str:
-    # Remove http links
-    return re.sub(r'http\S+', '<removed-link>', content)
-
-@transaction.atomic
-def visit_email(fd, path: str) -> bool:
-    if Email.objects.filter(original_path=path).exists():
+def split_body(content: str, size: int) -> list:
+    # Chunks end on a whitespace when possible, so that words aren't split between chunks
+    chunks = []
+    while len(content) > size:
+        end = max(content.rfind(' ', size // 2, size), content.rfind('\n', size // 2, size))
+        if end <= 0:
+            end = size
+
+        chunks.append(content[:end])
+        content = content[end:]
+
+    if content:
+        chunks.append(content)
+
+    return chunks
+
+class ParsedEmail:
+    def __init__(self, entry: Email):
+        self.entry = entry
+        self.to = []
+        self.cc = []
+        self.attachments = []
+        self.references = [] # Message ids from In-Reply-To and References
+        self.body_chunks = [] # Rest of the body after content_text
+        self.file = None # Manifest entry, when indexing incrementally
+
+def read_message(fd) -> email.message.Message:
+    # Parsing bytes lets each part be decoded with its own charset, and avoids decoding attachments as text
+    return email.message_from_binary_file(fd)
+
+def set_body(parsed: ParsedEmail, text: str):
+    # The first chunk of the body is stored in content_text, the following ones in EmailBodyChunk
+    chunks = split_body(text, settings.MAX_EMAIL_CONTENT_SIZE)
+    if len(chunks) > settings.MAX_EMAIL_BODY_CHUNKS:
+        parsed.entry.add_indexing_note(f'Body is too long ({len(text)}), only indexing the first {settings.MAX_EMAIL_BODY_CHUNKS} chunks')
+        chunks = chunks[:settings.MAX_EMAIL_BODY_CHUNKS]
+
+    parsed.entry.content_text = chunks[0] if chunks else text
+    parsed.body_chunks = [EmailBodyChunk(position=position, content=chunk) for position, chunk in enumerate(chunks[1:], 1)]
+
+def shrink_first_chunk(parsed: ParsedEmail) -> bool:
+    # Moves the end of content_text to its own chunk, so that content_text fits in the trigram index.
+    # Returns False if it can't be shrunk any further
+    text = parsed.entry.content_text
+    if text is None or len(text) <= 100:
         return False
 
-    content = email.message_from_string(utf8_decode(fd.read()))
-    message_id = content.get('Message-id')
-    if not message_id:
-        message_id = f'<none>:{os.path.basename(path)}'
+    head, *tail = split_body(text, len(text) // 2)
+    parsed.entry.add_indexing_note(f'Exceeded index size, moving the end of the first chunk to the next one (original size: {len(text)}, reduced: {len(head)})')
 
-    if Email.objects.filter(message_id=message_id).exists():
-        return False
+    chunks = [''.join(tail)] + [e.content for e in parsed.body_chunks]
+    parsed.entry.content_text = head
+    parsed.body_chunks = [EmailBodyChunk(position=position, content=chunk) for position, chunk in enumerate(chunks, 1)]
 
-    new_entry = Email(message_id=message_id, original_path=path)
-    new_entry.subject = decode_header(content.get('Subject'), new_entry, 1024)
-    new_entry.in_reply_to = decode_header(content.get('In-Reply-To'), new_entry, 1024)
-    author = decode_header(content.get('From'), new_entry, 1024)
-    new_entry.author = get_or_create_address(author) if author and author != '<decode-error>' else None
-    new_entry.date = decode_date(content.get('Date'), new_entry)
+    return True
 
-    new_entry.save()
+def parse_body(content: email.message.Message, parsed: ParsedEmail, path: str):
+    new_entry = parsed.entry
+    text = None
+    html_content = None
 
     if content.is_multipart():
         for entry in content.walk():
@@ -164,18 +338,16 @@ def visit_email(fd, path: str) -> bool:
             disposition = entry.get_content_disposition()
 
             if disposition is not None and 'attachment' in disposition:
-                attachment = EmailAttachment(source_email=new_entry,
-                                             file_name = decode_header(entry.get_filename(), new_entry, max_size = 1024),
+                attachment = EmailAttachment(file_name = decode_header(entry.get_filename(), new_entry, max_size = 1024),
                                              content_type = type,
-                                             content = entry.get_payload(decode=True))
-                attachment.save()
-                logger.debug(f'Created attachment {attachment} for email {new_entry}. Filename = {attachment.file_name}, ContentType = {attachment.content_type}')
+                                             content = get_attachment_payload(entry))
+                parsed.attachments.append(attachment)
                 continue
 
             if type == 'text/plain':
-                new_entry.content_text = process_text_content(utf8_decode(entry.get_payload(decode=True))[:settings.MAX_EMAIL_CONTENT_SIZE])
+                text = process_text_content(decode_payload(entry))
             elif type == 'text/html':
-                new_entry.content_html= utf8_decode(entry.get_payload(decode=True))[:settings.MAX_EMAIL_CONTENT_SIZE]
+                html_content = decode_payload(entry)
             elif type == 'text/calendar':
                 pass # TODO
             elif type not in ['multipart/alternative', 'multipart/mixed', 'multipart/signed', 'multipart/report', 'message/delivery-status', 'message/rfc822']  and disposition != 'inline':
@@ -183,104 +355,511 @@ def visit_email(fd, path: str) -> bool:
                 logger.warning(f'Unknown part content type while reading {path}. Content-Type={type}, disposition={disposition}')
     else:
         if 'Content-Type' in content and 'html' in decode_header(content['Content-Type'], new_entry, 1024).casefold():
-            new_entry.content_html = process_text_content(utf8_decode(content.get_payload(decode=True))[:settings.MAX_EMAIL_CONTENT_SIZE])
+            html_content = decode_payload(content)
         else:
-            new_entry.content_text = process_text_content(utf8_decode(content.get_payload(decode=True))[:settings.MAX_EMAIL_CONTENT_SIZE])
+            text = process_text_content(decode_payload(content))
+
+    # The whole body is indexed via the text content, so the html is only kept up to the size of a chunk
+    if html_content is not None:
+        new_entry.content_html = html_content[:settings.MAX_EMAIL_CONTENT_SIZE]
 
     # Generate a text content field for easier search if none was available
-    if new_entry.content_text is None and new_entry.content_html:
-        new_entry.content_text = extract_text_from_html(new_entry.content_html)
+    if text is None and html_content:
+        text = extract_text_from_html(html_content)
+
+    if text is not None:
+        set_body(parsed, text)
+
+def parse_email(fd, path: str, pending: set = None) -> ParsedEmail:
+    # Returns None if the email is already indexed (or is part of the pending batch)
+    if Email.objects.filter(original_path=path).exists():
+        return None
+
+    content = read_message(fd)
+    message_id = content.get('Message-id')
+    if not message_id:
+        message_id = f'<none>:{os.path.basename(path)}'
+    else:
+        message_id = str(message_id).replace("\x00", "\uFFFD")[:1024] # Same limit as the other headers
+
+    if pending is not None and message_id in pending:
+        return None
+
+    if Email.objects.filter(message_id=message_id).exists():
+        return None
+
+    new_entry = Email(message_id=message_id, original_path=path)
+    parsed = ParsedEmail(new_entry)
+
+    new_entry.subject = decode_header(content.get('Subject'), new_entry, 1024)
+    new_entry.in_reply_to = decode_header(content.get('In-Reply-To'), new_entry, 1024)
+    parsed.references = parse_references(new_entry.in_reply_to, decode_header(content.get('References'), new_entry, max_size=None))
+    author = decode_header(content.get('From'), new_entry, 1024)
+    new_entry.author = get_or_create_address(author) if author and author != '<decode-error>' else None
+    new_entry.date = decode_date(content.get('Date'), new_entry)
 
-    def attempt_save() -> bool:
+    parse_body(content, parsed, path)
+
+    parsed.to = get_or_create_addresses(decode_header(content.get('To', None), new_entry, max_size=None))
+    parsed.cc = get_or_create_addresses(decode_header(content.get('CC', None), new_entry, max_size=None))
+
+    new_entry.headers = {}
+    for header, value in content.items():
+        if header.lower() in ['date', 'subject', 'in-reply-to', 'from', 'to', 'cc', 'message-id']:
+            continue
+
+        new_entry.headers.setdefault(header.lower().replace("\x00", "\uFFFD"), []).append(decode_header(value, new_entry, 1024))
+
+    if 'list-id' in new_entry.headers:
+        new_entry.list_id = Email.normalize_list_id(new_entry.headers['list-id'][0])
+
+    return parsed
+
+def bulk_insert(entries: list, exclude: list = []):
+    if not entries:
+        return
+
+    # bulk_create() doesn't support multi-table inheritance, so the IndexEntry parent rows are created first
+    parents = IndexEntry.objects.bulk_create([IndexEntry(type=e.entry_type, indexing_log=e.indexing_log) for e in entries])
+    for entry, parent in zip(entries, parents):
+        entry.id = entry.indexentry_ptr_id = parent.id
+        entry.type = parent.type
+        entry.created_timestamp = parent.created_timestamp
+
+    model = type(entries[0])
+    fields = [e for e in model._meta.local_concrete_fields if not e.generated and e.name not in exclude]
+    # Child rows are inserted like bulk_create() does internally, since its public API rejects multi-table inherited models
+    model._base_manager._insert(entries, fields=fields)
+
+    for entry in entries:
+        entry._state.adding = False
+        entry._state.db = parents[0]._state.db
+
+def insert_emails(emails: list):
+    for e in emails:
+        e.entry.attachment_count = len(e.attachments)
+        e.entry.attachment_bytes = sum(len(attachment.content or b'') for attachment in e.attachments)
+        e.entry.recipient_count = len({address.id for address in e.to}) + len({address.id for address in e.cc})
+
+    bulk_insert([e.entry for e in emails])
+
+    to = {(e.entry.id, address.id) for e in emails for address in e.to}
+    Email.to.through.objects.bulk_create([Email.to.through(email_id=email_id, emailaddress_id=address_id) for email_id, address_id in to])
+
+    cc = {(e.entry.id, address.id) for e in emails for address in e.cc}
+    Email.cc.through.objects.bulk_create([Email.cc.through(email_id=email_id, emailaddress_id=address_id) for email_id, address_id in cc])
+
+    for e in emails:
+        for attachment in e.attachments:
+            attachment.source_email = e.entry
+
+    attachments = [attachment for e in emails for attachment in e.attachments]
+    if get_storage() is not None:
+        store_attachments(attachments)
+        bulk_insert(attachments, exclude=['content'])
+    else:
+        bulk_insert(attachments)
+
+    for e in emails:
+        for chunk in e.body_chunks:
+            chunk.email = e.entry
+            chunk.search_vector = EmailBodyChunk.search_vector_expression(Value(chunk.content, output_field=TextField()))
+
+    EmailBodyChunk.objects.bulk_create([chunk for e in emails for chunk in e.body_chunks])
+
+    threads = [(e.entry, e.references) for e in emails]
+    insert_references(threads)
+    assign_threads(threads)
+
+    for e in emails:
+        logger.debug(f'Created new entry from {e.entry.original_path}: {e.entry} ({len(e.entry.headers)} headers, {len(e.attachments)} attachments)')
+
+def is_index_limit_error(error: OperationalError) -> bool:
+    return isinstance(error.__cause__, ProgramLimitExceeded) # Hit when the index row is too big
+
+@transaction.atomic
+def write_email(parsed: ParsedEmail) -> bool:
+    new_entry = parsed.entry
+
+    while True:
         try:
             with transaction.atomic():
-                new_entry.save()
-                return True
+                insert_emails([parsed])
 
-        except OperationalError as e:
-            if isinstance(e.__cause__, ProgramLimitExceeded):  # Hit when the index row is too big
+            return True
+        except IntegrityError:
+            # Another indexing process might have inserted the same email concurrently
+            if Email.objects.filter(Q(message_id=new_entry.message_id) | Q(original_path=new_entry.original_path)).exists():
+                logger.debug(f'Email {new_entry.message_id} from {new_entry.original_path} was concurrently indexed')
                 return False
-            else:
+            raise
+        except OperationalError as e:
+            # The trigram index of content_text stores every trigram of the value, which can exceed the index row size
+            if not is_index_limit_error(e) or not shrink_first_chunk(parsed):
                 raise
 
-    if not attempt_save():
-        previous_body = new_entry.content_text
-        new_entry.content_text = reduce_body_size(previous_body)
-        new_entry.add_indexing_note(f'Exceeded index size, reducing email content (original size: {len(previous_body)}, reduced: {len(new_entry.content_text)})')
+@transaction.atomic
+def visit_email(fd, path: str) -> bool:
+    parsed = parse_email(fd, path)
+    address_cache.flush()
 
-        note = None
-        while True:
-            if attempt_save():
-                break
+    if parsed is None:
+        return False
 
-            if len(new_entry.content_text) <= 100:
-                raise RuntimeError('Failed to save context_text for email: {path}')
+    created = write_email(parsed)
+    if created:
+        IndexGeneration.bump()
 
-            new_entry.content_text = new_entry.content_text[:len(new_entry.content_text) - 100]
-            note = f'Entry still too big. Reduced size to: {len(new_entry.content_text)}'
+    return created
 
-        if note is not None:
-            new_entry.add_indexing_note(note)
-            new_entry.save()
+def report_failure(path: str, pdb: bool):
+    # Called from an except block, which re-raises the error if indexing should stop
+    logging.error(f'Failed to index email: {path}, {traceback.format_exc()}')
 
+    if pdb:
+        import pdb
+        pdb.post_mortem()
 
-    for e in get_or_create_addresses(decode_header(content.get('To', None), new_entry, max_size=None)):
-        new_entry.to.add(e)
+class EmailBatch:
+    def __init__(self, stop: bool, pdb: bool):
+        self.stop = stop
+        self.pdb = pdb
+        self.emails = []
+        self.message_ids = set()
+        self.files = {} # Manifest entries for files that didn't produce a new email, by path
 
-    for e in get_or_create_addresses(decode_header(content.get('CC', None), new_entry, max_size=None)):
-        new_entry.cc.add(e)
+    def __len__(self):
+        return len(self.emails)
 
-    created_headers = 0
-    for header, content in content.items():
-        if header.lower() in ['date', 'subject', 'in-reply-to', 'from', 'to', 'cc', 'message-id']:
+    def add_file(self, entry: IndexedFile):
+        self.files[entry.path] = entry
+
+    def add(self, parsed: ParsedEmail):
+        self.emails.append(parsed)
+        self.message_ids.add(parsed.entry.message_id)
+
+    def flush(self) -> tuple:
+        emails = self.emails
+        files = self.files
+        self.emails = []
+        self.message_ids = set()
+        self.files = {}
+
+        address_cache.flush()
+
+        if not emails and not files:
+            return 0, 0, 0
+
+        try:
+            with transaction.atomic():
+                insert_emails(emails)
+                Manifest.save(list(files.values()) + [e.file for e in emails if e.file is not None])
+
+                # Last, so the row lock is only held until the batch commits
+                if emails:
+                    IndexGeneration.bump()
+
+            return len(emails), 0, 0
+        except Exception as e:
+            # Any error (duplicate, index row too big, invalid value...) is isolated by writing the emails one by one
+            logger.warning(f'Failed to write a batch of {len(emails)} emails, writing them one by one: {e}')
+
+        # Fallback to individual writes so a single bad email doesn't fail the whole batch
+        created = 0
+        existing = 0
+        failed = 0
+        for parsed in emails:
+            try:
+                if write_email(parsed):
+                    created += 1
+                else:
+                    existing += 1
+
+                if parsed.file is not None:
+                    files[parsed.file.path] = parsed.file
+            except:
+                report_failure(parsed.entry.original_path, self.pdb)
+                failed += 1
+
+                if self.stop:
+                    raise
+
+        if created:
+            IndexGeneration.bump()
+
+        Manifest.save(list(files.values()))
+
+        return created, existing, failed
+
+def list_files(path: str):
+    # Iterative to support arbitrarily deep trees. scandir() provides the entry type without an extra stat() call
+    pending = [path]
+
+    while pending:
+        folder = pending.pop()
+        logger.debug(f'Visting: {folder}')
+
+        with os.scandir(folder) as entries:
+            for e in entries:
+                if e.is_dir():
+                    pending.append(e.path)
+                elif e.is_file():
+                    yield e.path
+
+def list_maildir_files(path: str):
+    # Messages are stored in the cur/ and new/ folders of each maildir, tmp/ only contains incomplete deliveries
+    for item_path in list_files(path):
+        if os.path.basename(os.path.dirname(item_path)) in ['cur', 'new']:
+            yield item_path
+
+def list_source_files(path: str, format: str):
+    if format == 'maildir':
+        return list_maildir_files(path)
+    elif format == 'mbox' and os.path.isfile(path):
+        return [path]
+    else:
+        return list_files(path)
+
+class PrefetchedFile:
+    def __init__(self, path: str):
+        self.path = path
+        self.stat = None
+        self.content = None # None if the file was skipped by the manifest
+        self.error = None
+        self.progress = None # Manifest entry to save along with this file's batch
+
+def read_file(path: str, manifest: Manifest) -> PrefetchedFile:
+    file = PrefetchedFile(path)
+
+    try:
+        if manifest is not None:
+            file.stat = os.stat(path)
+            if manifest.is_unchanged(path, file.stat) or manifest.is_indexed(path):
+                return file
+
+        with open(path, 'rb') as fd:
+            file.content = fd.read()
+    except Exception as e:
+        file.error = e
+
+    return file
+
+def prefetch_files(paths, manifest: Manifest, depth: int = settings.INDEX_PREFETCH_SIZE):
+    # Files are read by a background thread so that I/O overlaps with parsing
+    files = queue.Queue(maxsize=depth)
+    done = object()
+
+    def read():
+        try:
+            for path in paths:
+                files.put(read_file(path, manifest))
+        except Exception as e:
+            files.put(e)
+        finally:
+            files.put(done)
+
+    threading.Thread(target=read, daemon=True).start()
+
+    while (file := files.get()) is not done:
+        if isinstance(file, Exception):
+            raise file
+
+        yield file
+
+def visit_path(file: PrefetchedFile, batch: EmailBatch, manifest: Manifest) -> ParsedEmail:
+    path = file.path
+    if file.error is not None:
+        raise file.error
+
+    if manifest is None:
+        return parse_email(io.BytesIO(file.content), path, batch.message_ids)
+
+    if file.content is None:
+        if manifest.is_indexed(path):
+            batch.add_file(manifest.entry(path, file.stat, None))
+
+        return None
+
+    entry = manifest.entry(path, file.stat, hash_content(file.content))
+    if manifest.has_content(path, entry.content_hash):
+        batch.add_file(entry)
+        return None
+
+    parsed = parse_email(io.BytesIO(file.content), path, batch.message_ids)
+    if parsed is None:
+        batch.add_file(entry)
+    else:
+        parsed.file = entry
+
+    return parsed
+
+def visit_items(files, stop: bool, pdb: bool, batch_size: int, manifest: Manifest = None) -> tuple:
+    created = 0
+    existing = 0
+    failed = 0
+
+    batch = EmailBatch(stop, pdb)
+
+    def flush():
+        nonlocal created, existing, failed
+
+        batch_created, batch_existing, batch_failed = batch.flush()
+        created += batch_created
+        existing += batch_existing
+        failed += batch_failed
+
+    for file in files:
+        try:
+            parsed = visit_path(file, batch, manifest)
+        except:
+            report_failure(file.path, pdb)
+            failed += 1
+
+            if stop:
+                raise
             continue
+        finally:
+            if file.progress is not None:
+                batch.add_file(file.progress)
 
-        content = decode_header(content, new_entry, 1024)
+        if parsed is None:
+            existing += 1
+            if len(batch.files) >= batch_size:
+                flush()
 
-        new_header = EmailHeader(source_email=new_entry, name=header, value=content)
-        new_header.save()
+            continue
 
-        created_headers += 1
+        batch.add(parsed)
+        if len(batch) >= batch_size:
+            flush()
 
-    logger.debug(f'Created new entry from {path}: {new_entry} ({created_headers} headers)')
+    flush()
 
-    return True
+    return created, existing, failed
+
+def visit_files(paths, stop: bool, pdb: bool, batch_size: int, manifest: Manifest = None) -> tuple:
+    return visit_items(prefetch_files(paths, manifest), stop, pdb, batch_size, manifest)
+
+def read_mbox_messages(path: str):
+    stat = os.stat(path)
 
+    # Resume after the last committed batch, unless the file was replaced or truncated since
+    offset = 0
+    entry = IndexedFile.objects.filter(path=path).first()
+    if entry is not None and entry.offset is not None and entry.inode == stat.st_ino and entry.offset <= stat.st_size:
+        offset = entry.offset
+        logger.debug(f'Resuming {path} from offset {offset}')
 
-def visit_folder(path: str, stop: bool, pdb: bool):
-    logger.debug(f'Visting: {path}')
+    for offset, next_offset, content in read_mbox(path, offset):
+        file = PrefetchedFile(f'{path}#{offset}')
+        file.content = content
+        file.progress = IndexedFile(path=path, size=stat.st_size, mtime=stat.st_mtime_ns, inode=stat.st_ino, offset=next_offset)
 
+        yield file
+
+def visit_mboxes(paths, stop: bool, pdb: bool, batch_size: int) -> tuple:
     created = 0
     existing = 0
     failed = 0
 
-    for e in os.listdir(path):
-        item_path = os.path.join(path, e)
+    for path in paths:
+        try:
+            messages = read_mbox_messages(path)
+            mbox_created, mbox_existing, mbox_failed = visit_items(messages, stop, pdb, batch_size)
+        except:
+            report_failure(path, pdb)
+            failed += 1
 
-        if os.path.isdir(item_path):
-            dir_created, dir_existing, dir_failed = visit_folder(item_path, stop, pdb)
+            if stop:
+                raise
+            continue
 
-            created += dir_created
-            existing += dir_existing
-            failed += dir_failed
+        created += mbox_created
+        existing += mbox_existing
+        failed += mbox_failed
 
-        elif os.path.isfile(item_path):
-            try:
-                with open(item_path, 'rb') as fd:
-                    if visit_email(fd, item_path):
-                        created += 1
-                    else:
-                        existing += 1
-            except:
-                logging.error(f'Failed to parse email: {item_path}, {traceback.format_exc()}')
+    return created, existing, failed
+
+def load_manifest(path: str, incremental: bool) -> Manifest:
+    if not incremental:
+        return None
 
-                if pdb:
-                    import pdb
-                    pdb.post_mortem()
+    manifest = Manifest(path)
+    manifest.load()
 
-                failed += 1
+    return manifest
 
-                if stop:
-                    raise
+def visit_folder(path: str, stop: bool, pdb: bool, batch_size: int = settings.INDEX_BATCH_SIZE, incremental: bool = False, format: str = 'eml'):
+    address_cache.preload()
+
+    if format == 'mbox':
+        # mbox files are always resumed from the last indexed offset, so the manifest isn't needed
+        return visit_mboxes(list_source_files(path, format), stop, pdb, batch_size)
+    else:
+        return visit_files(list_source_files(path, format), stop, pdb, batch_size, load_manifest(path, incremental))
+
+def chunks(iterable, size: int):
+    chunk = []
+    for e in iterable:
+        chunk.append(e)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+worker_manifest = None
+
+def init_worker(manifest: Manifest):
+    global worker_manifest
+    worker_manifest = manifest
+
+    # Only needed when the 'spawn' start method is used. Database connections are opened lazily by each worker
+    django.setup()
+
+def visit_files_worker(paths: list, stop: bool, batch_size: int, format: str) -> tuple:
+    if format == 'mbox':
+        return visit_mboxes(paths, stop=stop, pdb=False, batch_size=batch_size)
+    else:
+        return visit_files(paths, stop=stop, pdb=False, batch_size=batch_size, manifest=worker_manifest)
+
+def visit_folder_parallel(path: str, workers: int, stop: bool, batch_size: int = settings.INDEX_BATCH_SIZE, incremental: bool = False, format: str = 'eml'):
+    created = 0
+    existing = 0
+    failed = 0
+
+    # Preloaded before forking so the workers start with a warm cache
+    address_cache.preload()
+    manifest = load_manifest(path, incremental and format != 'mbox')
+
+    # Don't share the parent's database connection with the worker processes
+    connections.close_all()
+
+    def changed_files():
+        nonlocal existing
+
+        for item_path in list_source_files(path, format):
+            if manifest is not None and manifest.is_unchanged(item_path, os.stat(item_path)):
+                existing += 1
+            else:
+                yield item_path
+
+    # Bound the number of queued batches, otherwise the pool would consume the whole tree upfront
+    pending = threading.BoundedSemaphore(workers * 2)
+
+    def pending_batches():
+        # Each mbox file is indexed by a single worker, so that its offset is committed in order
+        for chunk in chunks(changed_files(), 1 if format == 'mbox' else batch_size):
+            pending.acquire()
+            yield chunk
+
+    worker = functools.partial(visit_files_worker, stop=stop, batch_size=batch_size, format=format)
+    with multiprocessing.Pool(workers, initializer=init_worker, initargs=(manifest,)) as pool:
+        for batch_created, batch_existing, batch_failed in pool.imap_unordered(worker, pending_batches()):
+            pending.release()
+            created += batch_created
+            existing += batch_existing
+            failed += batch_failed
 
     return created, existing, failed
@@ -0,0 +1,49 @@
+from searchix.models import IndexedFile, Email
+
+import hashlib
+import logging
+
+logger = logging.Logger(__name__)
+
+
+def hash_content(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+class Manifest:
+    def __init__(self, root: str):
+        self.root = root
+        self.files = {} # path -> (size, mtime, inode)
+        self.indexed = set() # Paths indexed before the manifest existed
+
+    def load(self):
+        for path, size, mtime, inode in IndexedFile.objects.filter(path__startswith=self.root).values_list('path', 'size', 'mtime', 'inode').iterator():
+            self.files[path] = (size, mtime, inode)
+
+        for path in Email.objects.filter(original_path__startswith=self.root).values_list('original_path', flat=True).iterator():
+            if path not in self.files:
+                self.indexed.add(path)
+
+        logger.debug(f'Loaded manifest for {self.root}: {len(self.files)} files, {len(self.indexed)} indexed without manifest entry')
+
+    @staticmethod
+    def signature(stat) -> tuple:
+        return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+    def is_unchanged(self, path: str, stat) -> bool:
+        return self.files.get(path) == self.signature(stat)
+
+    def is_indexed(self, path: str) -> bool:
+        return path in self.indexed
+
+    def has_content(self, path: str, content_hash: str) -> bool:
+        # Only called for files whose stat changed, so the hash is fetched on demand
+        return path in self.files and IndexedFile.objects.filter(path=path, content_hash=content_hash).exists()
+
+    def entry(self, path: str, stat, content_hash: str) -> IndexedFile:
+        size, mtime, inode = self.signature(stat)
+        return IndexedFile(path=path, size=size, mtime=mtime, inode=inode, content_hash=content_hash)
+
+    @staticmethod
+    def save(entries: list):
+        if entries:
+            IndexedFile.objects.bulk_create(entries, update_conflicts=True, unique_fields=['path'], update_fields=['size', 'mtime', 'inode', 'content_hash', 'offset'])
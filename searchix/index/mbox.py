@@ -0,0 +1,31 @@
+import mmap
+import re
+
+separator = b'\nFrom '
+escaped_from = re.compile(rb'^>(>*From )', re.MULTILINE)
+
+
+def unescape(message: bytes) -> bytes:
+    # mboxrd quotes body lines starting with 'From ' as '>From '
+    return escaped_from.sub(rb'\1', message)
+
+def read_mbox(path: str, offset: int = 0):
+    # Yields (offset, next_offset, message) for each message, starting at offset. The file is memory-mapped, so
+    # only the current message is copied in memory
+    with open(path, 'rb') as fd:
+        if offset >= fd.seek(0, 2):
+            return
+
+        with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as content:
+            while offset < len(content):
+                end = content.find(separator, offset)
+                end = len(content) if end < 0 else end + 1
+
+                message = content[offset:end]
+                if message.startswith(b'From '):
+                    message = message[message.find(b'\n') + 1:] # Remove the envelope line
+
+                if message.strip():
+                    yield offset, end, unescape(message)
+
+                offset = end
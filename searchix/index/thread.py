@@ -0,0 +1,124 @@
+from searchix.models import Email, ThreadReference
+from django.db import connection, transaction
+from django.db.models import Q
+
+import logging
+import re
+
+logger = logging.Logger(__name__)
+
+message_id_pattern = re.compile(r'<[^<>\s]+>')
+reconcile_lock_id = 0x7468726561647321 # Advisory lock serializing reconcile_threads()
+
+
+def parse_references(in_reply_to: str, references: str) -> list:
+    # Message ids of the ancestors of an email, closest ancestor last (like the References header)
+    result = []
+    for value in [references, in_reply_to]:
+        if not value:
+            continue
+
+        for message_id in message_id_pattern.findall(value) or [value.strip()]:
+            message_id = message_id[:1024]
+            if message_id not in result:
+                result.append(message_id)
+
+    return result
+
+def insert_references(entries: list):
+    # entries: list of (Email, [referenced message ids])
+    ThreadReference.objects.bulk_create([ThreadReference(email=entry, message_id=message_id) for entry, references in entries for message_id in references])
+
+    # Related emails written by concurrent transactions aren't visible yet, so the threads are linked again once committed
+    transaction.on_commit(lambda: reconcile_threads(entries), robust=True)
+
+def find_threads(message_ids: list) -> tuple:
+    # Threads of the emails that have one of these message ids (the emails themselves and their ancestors), and threads of the emails
+    # that reference one of them (descendants that were indexed before their parent, and siblings whose parent is missing), by message id
+    emails = {}
+    for message_id, thread_id in Email.objects.filter(message_id__in=message_ids).exclude(thread_id=None).values_list('message_id', 'thread_id'):
+        emails.setdefault(message_id, set()).add(thread_id)
+
+    references = {}
+    for message_id, thread_id in ThreadReference.objects.filter(message_id__in=message_ids).exclude(email__thread_id=None).values_list('message_id', 'email__thread_id'):
+        references.setdefault(message_id, set()).add(thread_id)
+
+    return emails, references
+
+class ThreadMerger:
+    # Merges threads in memory (each into the smallest thread id), so that a whole batch is written with one update per thread
+    def __init__(self, message_ids: list):
+        self.emails, self.references = find_threads(message_ids)
+        self.parents = {}
+
+    def related_threads(self, entry: Email, references: list) -> set:
+        return {thread_id for message_id in [entry.message_id] + references for thread_id in self.emails.get(message_id, set()) | self.references.get(message_id, set())}
+
+    def find(self, thread_id: int) -> int:
+        while self.parents.get(thread_id, thread_id) != thread_id:
+            thread_id = self.parents[thread_id]
+
+        return thread_id
+
+    def merge(self, threads: set) -> int:
+        # Returns the id of the merged thread
+        roots = {self.find(e) for e in threads}
+        thread_id = min(roots)
+
+        for e in roots - {thread_id}:
+            self.parents[e] = thread_id
+
+        return thread_id
+
+    def add(self, entry: Email, references: list):
+        # Links the following emails of the batch to this one
+        self.emails.setdefault(entry.message_id, set()).add(entry.thread_id)
+        for message_id in references:
+            self.references.setdefault(message_id, set()).add(entry.thread_id)
+
+    def save(self, entries: list = []):
+        # Moves the emails of merged threads, and assigns the entries to their thread
+        merged = {}
+        for thread_id in self.parents:
+            if self.find(thread_id) != thread_id:
+                merged.setdefault(self.find(thread_id), set()).add(thread_id)
+
+        assigned = {}
+        for entry in entries:
+            entry.thread_id = self.find(entry.thread_id)
+            assigned.setdefault(entry.thread_id, []).append(entry.id)
+
+        for thread_id in merged.keys() | assigned.keys():
+            if thread_id in merged:
+                logger.debug(f'Merging threads {merged[thread_id]} into {thread_id}')
+
+            Email.objects.filter(Q(thread_id__in=merged.get(thread_id, [])) | Q(id__in=assigned.get(thread_id, []))).update(thread_id=thread_id)
+
+def batch_message_ids(entries: list) -> list:
+    return list({message_id for entry, references in entries for message_id in [entry.message_id] + references})
+
+def assign_threads(entries: list):
+    # Links each email to the thread of the emails it's related to, merging threads if it relates several of them.
+    # Emails must be inserted (with their references) first. Entries are processed in order, so emails of the same batch are linked too
+    threads = ThreadMerger(batch_message_ids(entries))
+
+    for entry, references in entries:
+        entry.thread_id = threads.merge(threads.related_threads(entry, references) | {entry.id})
+        threads.add(entry, references)
+
+    threads.save([entry for entry, references in entries])
+
+@transaction.atomic
+def reconcile_threads(entries: list):
+    # Merges the threads that assign_threads() couldn't link because the related emails weren't committed yet (concurrent indexing processes).
+    # Serialized, so that each pass sees the emails and merges committed by the previous ones
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_advisory_xact_lock(%s)', [reconcile_lock_id])
+
+    threads = ThreadMerger(batch_message_ids(entries))
+    for entry, references in entries:
+        related = threads.related_threads(entry, references) # Includes the email's own thread
+        if len(related) > 1:
+            threads.merge(related)
+
+    threads.save()
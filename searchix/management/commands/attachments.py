@@ -0,0 +1,89 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from searchix.models import EmailAttachment, AttachmentBlob
+from searchix.storage import get_storage, store_attachments
+from searchix import setup_logging
+
+setup_logging()
+class Command(BaseCommand):
+    help = "Manage attachment storage"
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['migrate', 'cleanup'], help='migrate: move inline attachments to the storage backend, cleanup: delete unreferenced blobs, and stored files without a blob (not to be run while indexing)')
+        parser.add_argument('--batch-size', type=int, default=100)
+
+    def handle(self, *args, **options):
+        if get_storage() is None:
+            raise CommandError('No attachment storage configured (see ATTACHMENT_STORAGE in settings.py)')
+
+        if options['action'] == 'migrate':
+            self.migrate(options['batch_size'])
+        else:
+            self.cleanup(options['batch_size'])
+
+    def migrate(self, batch_size: int):
+        moved = 0
+        last_id = 0
+
+        while True:
+            with transaction.atomic():
+                batch = list(EmailAttachment.objects.filter(id__gt=last_id, blob=None, content__isnull=False).only('id', 'content').order_by('id')[:batch_size])
+                if not batch:
+                    break
+
+                store_attachments(batch)
+                for e in batch:
+                    e.content = None
+
+                EmailAttachment.objects.bulk_update(batch, ['blob', 'content'])
+
+            last_id = batch[-1].id
+            moved += len(batch)
+            print(f'Moved {moved} attachments')
+
+        print(f'Done. Run "VACUUM FULL {EmailAttachment._meta.db_table}" to reclaim the space used by inline attachments')
+
+    def cleanup(self, batch_size: int):
+        storage = get_storage()
+        deleted = 0
+
+        while True:
+            with transaction.atomic():
+                batch = list(AttachmentBlob.objects.select_for_update(skip_locked=True).filter(references__lte=0)[:batch_size])
+                if not batch:
+                    break
+
+                AttachmentBlob.objects.filter(id__in=[e.id for e in batch]).delete()
+
+            for e in batch:
+                storage.delete(e.hash)
+
+            deleted += len(batch)
+
+        print(f'Deleted {deleted} unreferenced blobs')
+
+        self.sweep(batch_size)
+
+    def sweep(self, batch_size: int):
+        # Files without a blob row, written by indexing batches that were rolled back
+        storage = get_storage()
+        deleted = 0
+
+        def delete_orphans(keys: list) -> int:
+            existing = set(AttachmentBlob.objects.filter(hash__in=keys).values_list('hash', flat=True))
+            orphans = [e for e in keys if e not in existing]
+            for e in orphans:
+                storage.delete(e)
+
+            return len(orphans)
+
+        keys = []
+        for key in storage.keys():
+            keys.append(key)
+            if len(keys) >= batch_size:
+                deleted += delete_orphans(keys)
+                keys = []
+
+        deleted += delete_orphans(keys)
+
+        print(f'Deleted {deleted} orphaned files')
@@ -0,0 +1,133 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import BigIntegerField, Count, F, Func, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+from searchix.models import Email, EmailAttachment, EmailHeader, IndexEntry, IndexGeneration, ThreadReference
+from searchix.index.thread import parse_references, insert_references, assign_threads
+from searchix import setup_logging
+
+setup_logging()
+class Command(BaseCommand):
+    help = "Fill columns added to existing emails by newer versions"
+
+    def add_arguments(self, parser):
+        parser.add_argument('target', choices=['threads', 'counters', 'headers', 'lists'])
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--all', action='store_true', help='Also update emails that are already filled')
+
+    def handle(self, *args, **options):
+        getattr(self, options['target'])(options['batch_size'], options['all'])
+
+    def update_in_batches(self, queryset, batch_size: int, **values):
+        updated = 0
+        last_id = 0
+
+        while True:
+            ids = list(queryset.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:batch_size])
+            if not ids:
+                break
+
+            with transaction.atomic():
+                queryset.model.objects.filter(id__in=ids).update(**values)
+                IndexGeneration.bump()
+
+            last_id = ids[-1]
+            updated += len(ids)
+            print(f'Updated {updated} emails')
+
+    def counters(self, batch_size: int, all: bool):
+        def aggregate(queryset, field: str, value):
+            return Coalesce(Subquery(queryset.filter(**{field: OuterRef('pk')}).values(field).annotate(value=value).values('value')), 0)
+
+        attachments = EmailAttachment.objects.all()
+        size = Coalesce('blob__size', Func('content', function='octet_length'), 0, output_field=BigIntegerField())
+
+        queryset = Email.objects.all() if all else Email.objects.filter(attachment_count=None)
+        self.update_in_batches(queryset, batch_size,
+                               attachment_count=aggregate(attachments, 'source_email', Count('id')),
+                               attachment_bytes=aggregate(attachments, 'source_email', Sum(size)),
+                               recipient_count=aggregate(Email.to.through.objects.all(), 'email', Count('id')) + aggregate(Email.cc.through.objects.all(), 'email', Count('id')))
+
+    def threads(self, batch_size: int, all: bool):
+        if all:
+            with transaction.atomic():
+                ThreadReference.objects.all().delete()
+                Email.objects.update(thread_id=None)
+
+        updated = 0
+        last_id = 0
+
+        while True:
+            emails = list(Email.objects.filter(thread_id=None, id__gt=last_id).order_by('id').only('id', 'message_id', 'in_reply_to', 'headers')[:batch_size])
+            if not emails:
+                break
+
+            # The References header isn't a column, it's stored with the other headers (in EmailHeader rows if they're not folded yet, see headers())
+            legacy_references = dict(EmailHeader.objects.filter(source_email__in=[e for e in emails if e.headers is None], name__iexact='references').values_list('source_email_id', 'value'))
+            references = {e.id: ' '.join(e.headers.get('references', [])) for e in emails if e.headers is not None}
+            entries = [(e, parse_references(e.in_reply_to, references.get(e.id) or legacy_references.get(e.id))) for e in emails]
+
+            with transaction.atomic():
+                insert_references(entries)
+                assign_threads(entries)
+                IndexGeneration.bump()
+
+            last_id = emails[-1].id
+            updated += len(emails)
+            print(f'Updated {updated} emails')
+
+    def headers(self, batch_size: int, all: bool):
+        # Folds the EmailHeader rows of emails indexed by previous versions into Email.headers
+        folded = 0
+
+        while True:
+            with transaction.atomic():
+                ids = list(EmailHeader.objects.order_by('source_email_id').values_list('source_email_id', flat=True).distinct()[:batch_size])
+                if not ids:
+                    break
+
+                emails = {e.id: e for e in Email.objects.filter(id__in=ids).only('id', 'headers')}
+                headers = list(EmailHeader.objects.filter(source_email_id__in=ids).order_by('id').values_list('id', 'source_email_id', 'name', 'value'))
+
+                for id, email_id, name, value in headers:
+                    entry = emails[email_id]
+                    if entry.headers is None:
+                        entry.headers = {}
+
+                    entry.headers.setdefault(name.lower(), []).append(value)
+
+                Email.objects.bulk_update(emails.values(), ['headers'])
+
+                # Deleted without the ORM's collector, which would load every header
+                header_ids = [e[0] for e in headers]
+                EmailHeader.objects.filter(id__in=header_ids)._raw_delete(EmailHeader.objects.db)
+                IndexEntry.objects.filter(id__in=header_ids)._raw_delete(IndexEntry.objects.db)
+                IndexGeneration.bump()
+
+            folded += len(ids)
+            print(f'Folded the headers of {folded} emails')
+
+    def lists(self, batch_size: int, all: bool):
+        # Run after headers, since the list id is read from Email.headers
+        queryset = Email.objects.filter(headers__has_key='list-id')
+        if not all:
+            queryset = queryset.filter(list_id=None)
+
+        updated = 0
+        last_id = 0
+
+        while True:
+            emails = list(queryset.filter(id__gt=last_id).order_by('id').only('id', 'headers')[:batch_size])
+            if not emails:
+                break
+
+            for e in emails:
+                e.list_id = Email.normalize_list_id(e.headers['list-id'][0])
+
+            with transaction.atomic():
+                Email.objects.bulk_update(emails, ['list_id'])
+                IndexGeneration.bump()
+
+            last_id = emails[-1].id
+            updated += len(emails)
+            print(f'Updated {updated} emails')
@@ -0,0 +1,158 @@
+import io
+import os
+import re
+import time
+import tracemalloc
+from email import message_from_string
+from email.message import EmailMessage
+from django.core.management.base import BaseCommand, CommandError
+from html2text import HTML2Text
+from searchix.index import email
+from searchix.models import Email
+
+
+def generate_emails(count: int, attachment_size: int) -> list:
+    emails = []
+    for i in range(count):
+        message = EmailMessage()
+        message['From'] = f'Sender {i} <sender{i}@example.org>'
+        message['To'] = 'Recipient <recipient@example.org>'
+        message['Subject'] = f'Benchmark email {i}'
+        message['Message-ID'] = f'<benchmark-{i}@example.org>'
+        message.set_content('Benchmark body with some non-ascii content: déjà vu, naïve café.\n' * 200)
+        message.add_alternative(f'<html><body>{"<p>Benchmark <b>body</b></p>" * 200}</body></html>', subtype='html')
+        message.add_attachment(os.urandom(attachment_size), maintype='application', subtype='octet-stream', filename=f'attachment-{i}.bin')
+        message.add_attachment(os.urandom(attachment_size // 2), maintype='image', subtype='png', filename=f'image-{i}.png')
+        emails.append(bytes(message))
+
+    return emails
+
+def generate_html(count: int) -> list:
+    # Samples of the html bodies seen in archives: simple messages, table based newsletters and very large bodies
+    simple = '<html><body>' + '<p>Hello, <b>this</b> is a simple message &amp; a <a href="https://example.org">link</a>.</p>' * 20 + '</body></html>'
+    newsletter = ('<html><head><style>td { color: red; }</style></head><body><table>'
+                  + '<tr><td><h2>Article title</h2></td><td><img src="cid:image"/><p>Article summary, with <i>some</i> details.</p><ul><li>First</li><li>Second</li></ul></td></tr>' * 50
+                  + '</table></body></html>')
+    large = '<html><body>' + '<div><p>Large body paragraph with <span>nested</span> markup.</p></div>' * 10000 + '</body></html>'
+
+    samples = [simple, newsletter, large]
+    return [samples[i % len(samples)] for i in range(count)]
+
+def read_emails(path: str) -> list:
+    emails = []
+    for item_path in email.list_files(path):
+        with open(item_path, 'rb') as fd:
+            emails.append(fd.read())
+
+    return emails
+
+def parse(content: bytes, legacy: bool):
+    if legacy:
+        # Previous implementation: decode the whole email as utf8 before parsing it
+        message = message_from_string(email.utf8_decode(content))
+    else:
+        message = email.read_message(io.BytesIO(content))
+
+    parsed = email.ParsedEmail(Email(message_id='<benchmark>', original_path='<benchmark>'))
+    email.parse_body(message, parsed, '<benchmark>')
+
+def read_html(emails: list) -> list:
+    parts = []
+    for content in emails:
+        for part in email.read_message(io.BytesIO(content)).walk():
+            if part.get_content_type() == 'text/html':
+                parts.append(email.decode_payload(part))
+
+    return parts
+
+def legacy_html_to_text(content: str) -> str:
+    # Previous implementation: always converted by html2text
+    convert = HTML2Text()
+    convert.ignore_images = True
+    convert.ignore_links = True
+    convert.ignore_emphasis = True
+    convert.ignore_tables = True
+    convert.single_line_break = True
+    convert.wrap_links = True
+    convert.wrap_lists = True
+
+    extracted = convert.handle(re.sub('<img .*?>', 'removed-image', content))
+    return extracted.encode(errors='replace').decode(errors='replace')
+
+def words(text: str) -> set:
+    return set(re.findall(r'\w+', text.casefold())) - {'removed', 'image'}
+
+def convert_html(parts: list, method) -> tuple:
+    start = time.perf_counter()
+    results = [method(e) for e in parts]
+
+    return time.perf_counter() - start, results
+
+class Command(BaseCommand):
+    help = "Measure the indexer's parsing time and peak memory usage, or compare html to text conversion"
+
+    def add_arguments(self, parser):
+        parser.add_argument('target', choices=['parse', 'html'])
+        parser.add_argument('--path', type=str, help='Folder of .eml files to use instead of generated emails')
+        parser.add_argument('--generate', type=int, default=20, help='Number of emails to generate')
+        parser.add_argument('--attachment-size', type=int, default=5 * 1024 * 1024, help='Size of the generated attachments')
+        parser.add_argument('--legacy', action='store_true', help='Parse emails from decoded text, like previous versions')
+
+    def handle(self, *args, **options):
+        if options['target'] == 'html':
+            self.html(options)
+        else:
+            self.parse(options)
+
+    def html(self, options):
+        if options.get('path'):
+            parts = read_html(read_emails(options['path']))
+        else:
+            parts = generate_html(options['generate'])
+
+        if not parts:
+            raise CommandError('No html bodies to convert')
+
+        legacy_time, legacy_results = convert_html(parts, legacy_html_to_text)
+        new_time, new_results = convert_html(parts, email.extract_text_from_html)
+
+        # Share of the words found by the previous implementation that are still extracted
+        coverage = [len(words(new) & words(legacy)) / len(words(legacy)) if words(legacy) else 1 for legacy, new in zip(legacy_results, new_results)]
+
+        size = sum(len(e) for e in parts) / 1024 / 1024
+        print(f'Html bodies: {len(parts)}, total size: {size:.2f} MB')
+        print(f'Previous: {legacy_time * 1000:.2f} ms ({size / legacy_time:.2f} MB/s)')
+        print(f'Current: {new_time * 1000:.2f} ms ({size / new_time:.2f} MB/s), {legacy_time / new_time:.1f}x faster')
+        print(f'Word coverage: average {sum(coverage) / len(coverage) * 100:.1f}%, minimum {min(coverage) * 100:.1f}%')
+
+    def parse(self, options):
+        if options.get('path'):
+            emails = read_emails(options['path'])
+        else:
+            emails = generate_emails(options['generate'], options['attachment_size'])
+
+        if not emails:
+            raise CommandError('No emails to parse')
+
+        legacy = options.get('legacy', False)
+
+        start = time.perf_counter()
+        for e in emails:
+            parse(e, legacy)
+
+        elapsed = time.perf_counter() - start
+
+        # Memory is measured in a separate pass since tracemalloc slows down parsing
+        peak = 0
+        tracemalloc.start()
+        for e in emails:
+            tracemalloc.reset_peak()
+            parse(e, legacy)
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+
+        tracemalloc.stop()
+
+        size = sum(len(e) for e in emails) / len(emails)
+        print(f'Emails: {len(emails)}, average size: {size / 1024 / 1024:.2f} MB')
+        print(f'Time per email: {elapsed / len(emails) * 1000:.2f} ms')
+        print(f'Peak memory per email: {peak / 1024 / 1024:.2f} MB')
@@ -0,0 +1,57 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from searchix.models import Email
+from searchix.query import parse_query, QueryError
+from searchix.search import search_emails, related_content, related_candidates, fuzzy_candidates, fuzzy_fields, set_fuzzy_threshold, text_query
+
+
+class Command(BaseCommand):
+    help = "Show the query plans of an email search, and fail if any of them scans a table sequentially"
+
+    def add_arguments(self, parser):
+        parser.add_argument('search_term', type=str)
+        parser.add_argument('--fuzzy', action='store_true')
+        parser.add_argument('--force-index', action='store_true', help='Disable sequential scans in the planner, to check that the indexes can be used on small databases')
+        parser.add_argument('--expect-index', action='append', default=[], help='Fail if none of the plans uses this index (can be repeated)')
+
+    def queries(self, options) -> list:
+        try:
+            search_term, condition = parse_query(options['search_term'])
+        except QueryError as e:
+            raise CommandError(str(e))
+
+        queryset = Email.objects.filter(condition)
+
+        if not search_term:
+            return [('search', queryset.order_by('-id')[:100])]
+
+        queries = [('search', search_emails(queryset, search_term, options['fuzzy']).order_by('-rank', '-id')[:100])]
+        queries += [(f'related candidates ({relation})', related_candidates(queryset, text_query(search_term), relation, limit)) for relation, model, email_field, limit in related_content]
+
+        if options['fuzzy']:
+            set_fuzzy_threshold()
+            queries += [(f'fuzzy candidates ({field})', query) for field, query in zip(fuzzy_fields, fuzzy_candidates(queryset, search_term))]
+
+        return queries
+
+    def handle(self, *args, **options):
+        if options['force_index']:
+            with connection.cursor() as cursor:
+                cursor.execute('SET enable_seqscan = off')
+
+        sequential_scans = []
+        plans = []
+        for name, query in self.queries(options):
+            plan = query.explain()
+            print(f'{name}:\n{plan}\n')
+            plans.append(plan)
+
+            if 'Seq Scan on searchix_' in plan:
+                sequential_scans.append(name)
+
+        if sequential_scans:
+            raise CommandError(f'Sequential scan found in: {", ".join(sequential_scans)}')
+
+        unused_indexes = [e for e in options['expect_index'] if not any(e in plan for plan in plans)]
+        if unused_indexes:
+            raise CommandError(f'Index not used: {", ".join(unused_indexes)}')
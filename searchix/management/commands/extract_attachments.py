@@ -0,0 +1,30 @@
+import logging
+from django.core.management.base import BaseCommand, CommandError
+from searchix.index import attachment
+from searchix import setup_logging
+
+setup_logging()
+class Command(BaseCommand):
+    help = "Extract and index the text of pending attachments"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1, help='Number of extraction processes')
+        parser.add_argument('--batch-size', type=int, default=100, help='Number of attachments extracted per transaction')
+
+    def handle(self, *args, **options):
+        attachment.logger.addHandler(logging.StreamHandler())
+
+        workers = options['workers']
+        batch_size = options['batch_size']
+
+        if workers < 1:
+            raise CommandError(f'Invalid number of workers: {workers}')
+        elif batch_size < 1:
+            raise CommandError(f'Invalid batch size: {batch_size}')
+
+        if workers > 1:
+            processed = attachment.extract_pending_parallel(workers, batch_size)
+        else:
+            processed = attachment.extract_pending(batch_size)
+
+        print(f'Processed {processed} attachments')
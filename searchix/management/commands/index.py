@@ -1,7 +1,7 @@
 import logging
 from django.core.management.base import BaseCommand, CommandError
 from searchix.index import email
-from searchix import setup_logging
+from searchix import setup_logging, settings
 import os
 import sys
 
@@ -14,6 +14,10 @@ class Command(BaseCommand):
         parser.add_argument('--stop', action='store_true')
         parser.add_argument('--pdb', action='store_true')
         parser.add_argument('--stdin', action='store_true')
+        parser.add_argument('--workers', type=int, default=1, help='Number of indexing processes')
+        parser.add_argument('--format', choices=['eml', 'mbox', 'maildir'], default='eml', help='Format of the files to index')
+        parser.add_argument('--incremental', action='store_true', help='Skip files that are unchanged since the last run')
+        parser.add_argument('--batch-size', type=int, default=settings.INDEX_BATCH_SIZE, help='Number of emails written per transaction')
 
     def handle(self, *args, **options):
         setup_logging()
@@ -21,17 +25,33 @@ class Command(BaseCommand):
 
         pdb = options.get('pdb', False)
         stop_on_error = options.get('stop', False)
+        workers = options.get('workers', 1)
+        batch_size = options.get('batch_size', settings.INDEX_BATCH_SIZE)
+        incremental = options.get('incremental', False)
+        format = options.get('format', 'eml')
+
+        if workers < 1:
+            raise CommandError(f'Invalid number of workers: {workers}')
+        elif workers > 1 and pdb:
+            raise CommandError('--pdb is not supported with multiple workers')
+        elif batch_size < 1:
+            raise CommandError(f'Invalid batch size: {batch_size}')
+
         if options.get('stdin', False):
             if email.visit_email(sys.stdin.buffer, options['path']):
                 print('Created new entry')
             else:
                 print('Entry already indexed')
-        elif os.path.isfile(options['path']):
+        elif os.path.isfile(options['path']) and format == 'eml':
             with open(options['path'], 'rb') as fd:
                 if email.visit_email(fd, options['path']):
                     print('Created new entry')
                 else:
                     print('Entry already indexed')
         else:
-            created, existing, failed = email.visit_folder(os.path.realpath(options['path']), stop=stop_on_error, pdb=pdb)
+            if workers > 1:
+                created, existing, failed = email.visit_folder_parallel(os.path.realpath(options['path']), workers=workers, stop=stop_on_error, batch_size=batch_size, incremental=incremental, format=format)
+            else:
+                created, existing, failed = email.visit_folder(os.path.realpath(options['path']), stop=stop_on_error, pdb=pdb, batch_size=batch_size, incremental=incremental, format=format)
+
             print(f'Created: {created}, existing; {existing}, failed: {failed}')
@@ -1,9 +1,14 @@
 from datetime import datetime
 from django.db.models import *
+from django.db.models.functions import Lower
 from django.contrib.postgres.search import SearchVectorField, SearchVector
-from django.contrib.postgres.indexes import GinIndex, GistIndex
+from django.contrib.postgres.indexes import BrinIndex, GinIndex, GistIndex, OpClass
 from django.db import transaction
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from enum import Enum
+import io
+import re
 
 
 class IndexEntry(Model):
@@ -20,6 +25,11 @@ class IndexEntry(Model):
     created_timestamp = DateTimeField(auto_now_add=True, blank=True, editable=False)
     indexing_log = CharField(max_length=10240, null=True, blank=True, editable=False)
 
+    class Meta:
+        indexes = [
+                    BrinIndex(fields=['created_timestamp'], name='created_timestamp_index'), # Rows are inserted in creation order
+                  ]
+
     def add_indexing_note(self, note: str):
         self.indexing_log = note if not self.indexing_log else self.indexing_log + '\n' + note
 
@@ -36,6 +46,14 @@ class EmailAddress(IndexEntry):
     address = EmailField(null=False, unique=True)
     display_names = CharField(max_length=1024, null=True, blank=True) # Comma separated list for simlicity
 
+    class Meta:
+        indexes = [
+                    Index(Lower('address'), name='address_lower_index'),
+                    Index(OpClass(Lower('address'), name='text_pattern_ops'), name='address_prefix_index'), # Prefix matches (LIKE 'prefix%')
+                    GinIndex(fields=['address'], name='address_trigram_index', opclasses=['gin_trgm_ops']),
+                    GinIndex(fields=['display_names'], name='display_names_trigram_index', opclasses=['gin_trgm_ops']),
+                  ]
+
     def names(self) -> list:
         if self.display_names is None:
             return []
@@ -62,16 +80,34 @@ class Email(IndexEntry):
     author = ForeignKey(EmailAddress, on_delete=CASCADE, null=True, blank=True, editable=False)
     to = ManyToManyField(EmailAddress, related_name='to', editable=False)
     cc = ManyToManyField(EmailAddress, related_name='cc', editable=False)
-    content_text = CharField(max_length=1024 * 60, null=True, blank=True, editable=False) # Size limit to not exceed the index row maximum
+    content_text = CharField(max_length=1024 * 60, null=True, blank=True, editable=False) # First chunk of the body, the rest is stored in EmailBodyChunk
     content_html = CharField(max_length=1024 * 1024 * 10, null=True, blank=True, editable=False)
     original_path = CharField(max_length=1024, editable=False, unique=True)
 
-    search = GeneratedField(db_persist=True,
-                            expression=SearchVector('content_text', 'content_html', 'subject',  config='english'),
-                            output_field=SearchVectorField())
+    # Weights are used by SearchRank: matches in the subject rank higher than in the body
+    search_vector = GeneratedField(db_persist=True,
+                                   expression=SearchVector('subject', weight='A', config='english')
+                                              + SearchVector('content_text', weight='B', config='english')
+                                              + SearchVector('content_html', weight='C', config='english'),
+                                   output_field=SearchVectorField())
+    thread_id = BigIntegerField(null=True, blank=True, editable=False) # Smallest email id of the thread, see index/thread.py
+
+    # Denormalized so that emails can be filtered without joining attachments or recipients. Null until backfilled for emails indexed by previous versions
+    attachment_count = PositiveIntegerField(null=True, blank=True, editable=False)
+    attachment_bytes = BigIntegerField(null=True, blank=True, editable=False)
+    recipient_count = PositiveIntegerField(null=True, blank=True, editable=False)
+
+    # Headers that don't have their own column, as {lowercase name: [values]}
+    headers = JSONField(null=True, blank=True, editable=False)
+    list_id = CharField(max_length=1024, null=True, blank=True, editable=False, db_index=True) # From the List-Id header, see normalize_list_id()
+
     class Meta:
         indexes = [
-                    GinIndex(fields=["search"]),
+                    GinIndex(fields=["search_vector"]),
+                    Index(fields=['thread_id', 'date'], name='thread_index'),
+                    Index(fields=['date'], name='date_index'), # B-tree, since archives aren't necessarily indexed in date order
+                    Index(fields=['attachment_count'], condition=Q(attachment_count__gt=0), name='with_attachment_index'),
+                    GinIndex(fields=['headers'], name='headers_index'), # Supports key (?) and containment (@>) lookups
                     GistIndex(fields=['subject'], name='subject_index', opclasses=['gist_trgm_ops']),
                     GistIndex(fields=['content_text'], name='text_trigram_index', opclasses=['gist_trgm_ops']),
                   ]
@@ -79,7 +115,42 @@ class Email(IndexEntry):
     def admin_link(self) -> str:
         return f'/searchix/email/{self.id}/change'
 
+    def thread_link(self) -> str:
+        return f'/searchix/email/?thread_id={self.thread_id}'
+
+    @staticmethod
+    def normalize_list_id(value: str) -> str:
+        # 'List name <list.example.org>' -> 'list.example.org'
+        match = re.search(r'<([^<>]+)>', value)
+        return (match.group(1) if match else value).strip().lower()[:1024]
+
+class EmailBodyChunk(Model):
+    # Part of a long body that follows Email.content_text. Each chunk has its own search vector, so that the whole body is searchable
+    email = ForeignKey(Email, on_delete=CASCADE, related_name='body_chunks')
+    position = PositiveIntegerField() # 1 for the first chunk after content_text
+    content = TextField()
+    search_vector = SearchVectorField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+                    GinIndex(fields=["search_vector"]),
+                  ]
+        constraints = [
+                    UniqueConstraint(fields=['email', 'position'], name='body_chunk_position'),
+                  ]
+
+    @staticmethod
+    def search_vector_expression(content='content'):
+        # Same weight as Email.content_text
+        return SearchVector(content, weight='B', config='english')
+
+class ThreadReference(Model):
+    # Message ids referenced by an email (In-Reply-To and References headers), used to link emails whose parent isn't indexed yet
+    email = ForeignKey(Email, on_delete=CASCADE, related_name='thread_references')
+    message_id = CharField(max_length=1024, db_index=True)
+
 class EmailHeader(IndexEntry):
+    # Only used by previous versions, headers are now stored in Email.headers (see backfill headers)
     entry_type = IndexEntry.ClassType.EmailHeader
 
     source_email = ForeignKey(Email, on_delete=CASCADE)
@@ -87,6 +158,13 @@ class EmailHeader(IndexEntry):
     value = CharField(max_length=1024 * 1024, null=True, blank=True)
 
 
+class AttachmentBlob(Model):
+    # Attachment payload, deduplicated by content and stored outside of the database (see storage.py)
+    hash = CharField(max_length=64, unique=True) # sha256
+    size = BigIntegerField()
+    references = PositiveIntegerField(default=0)
+
+
 class EmailAttachment(IndexEntry):
     def admin_link(self) -> str:
         return f'/searchix/emailattachment/{self.id}/change'
@@ -94,12 +172,68 @@ class EmailAttachment(IndexEntry):
     def download_link(self) -> str:
         return f'/download/attachment/{self.id}'
 
+    def open_content(self):
+        if self.blob_id is not None:
+            from searchix.storage import get_storage
+            return get_storage().open(self.blob.hash)
+        else:
+            return io.BytesIO(self.content or b'')
+
+
+    class TextStatus(IntegerChoices):
+        Pending = 0, 'Pending'
+        Extracted = 1, 'Extracted'
+        Unsupported = 2, 'Unsupported'
+        Failed = 3, 'Failed'
 
     entry_type = IndexEntry.ClassType.EmailAttachment
     source_email = ForeignKey(Email, on_delete=CASCADE)
     file_name = CharField(max_length=1024, null=True, blank=True)
     content_type = CharField(max_length=1024, null=True, blank=True)
-    content = BinaryField(null=True, blank=True)
+    content = BinaryField(null=True, blank=True) # Only set if the attachment is stored inline
+    blob = ForeignKey(AttachmentBlob, on_delete=PROTECT, null=True, blank=True)
+
+    # Text content is extracted in the background (see extract_attachments), pending attachments form the job queue
+    text_status = PositiveSmallIntegerField(choices=TextStatus, default=TextStatus.Pending, editable=False)
+    search_vector = SearchVectorField(null=True, blank=True, editable=False)
+
+    class Meta:
+        indexes = [
+                    GinIndex(fields=["search_vector"], name='attachment_search_index'),
+                    GinIndex(fields=['file_name'], name='attachment_file_name_index', opclasses=['gin_trgm_ops']),
+                    Index(fields=['indexentry_ptr'], condition=Q(text_status=0), name='attachment_pending_index'),
+                  ]
+
+    @staticmethod
+    def search_vector_expression(text='text'):
+        # Lowest weight: matches in attachments rank after matches in the email itself
+        return SearchVector(text, weight='D', config='english')
+
+
+@receiver(post_delete, sender=EmailAttachment)
+def release_attachment_blob(sender, instance, **kwargs):
+    if instance.blob_id is not None:
+        AttachmentBlob.objects.filter(id=instance.blob_id).update(references=F('references') - 1)
+
+
+class IndexedFile(Model):
+    # Manifest of the files seen by the indexer, used to skip unchanged files when re-indexing
+    path = CharField(max_length=1024, unique=True)
+    size = BigIntegerField()
+    mtime = BigIntegerField() # In nanoseconds
+    inode = BigIntegerField()
+    content_hash = CharField(max_length=64, null=True, blank=True) # sha256, null if the file was indexed before the manifest existed
+    offset = BigIntegerField(null=True, blank=True) # For mbox files, offset of the first message that isn't indexed yet
 
+class IndexGeneration(Model):
+    # Single row counter, incremented every time the indexer commits new content. Used to invalidate cached search results
+    value = BigIntegerField(default=0)
 
+    @staticmethod
+    def current() -> int:
+        return IndexGeneration.objects.filter(id=1).values_list('value', flat=True).first() or 0
 
+    @staticmethod
+    def bump():
+        IndexGeneration.objects.bulk_create([IndexGeneration(id=1)], ignore_conflicts=True)
+        IndexGeneration.objects.filter(id=1).update(value=F('value') + 1)
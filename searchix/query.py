@@ -0,0 +1,76 @@
+from django.db.models import Q
+from django.contrib.postgres.search import SearchQuery
+from searchix.models import Email, EmailAttachment
+from searchix.search import address_ids, normalize_search_term
+import datetime
+import re
+
+# Search operators, each compiled to a condition served by its own index. The rest of the search term is searched as text.
+# Values can be quoted: subject:"release notes"
+operator_pattern = re.compile(r'(?<!\S)(from|to|cc|subject|before|after|has|filename|list|header):([^\s"]*"[^"]*"|\S+)', re.IGNORECASE)
+
+
+class QueryError(ValueError):
+    pass
+
+def unquote(value: str) -> str:
+    if len(value) >= 2 and value.startswith('"') and value.endswith('"'):
+        return value[1:-1]
+
+    return value
+
+def parse_date(value: str) -> datetime.date:
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        raise QueryError(f'Invalid date: {value} (expected YYYY-MM-DD)')
+
+def recipients(relation, value: str) -> Q:
+    # Semi-join on the recipients table, by the ids of the matching addresses
+    return Q(id__in=relation.through.objects.filter(emailaddress_id__in=address_ids(value)).values('email_id'))
+
+def subject(value: str) -> Q:
+    # Only matches the subject's lexemes (weight A in the search vector)
+    words = re.findall(r'\w+', value)
+    if not words:
+        raise QueryError(f'Invalid subject: {value}')
+
+    return Q(search_vector=SearchQuery(' & '.join(f'{e}:A' for e in words), search_type='raw', config='english'))
+
+def has(value: str) -> Q:
+    if value.lower() != 'attachment':
+        raise QueryError(f'Unknown value for has: {value} (supported: attachment)')
+
+    return Q(attachment_count__gt=0)
+
+def filename(value: str) -> Q:
+    # Case insensitive regex, served by the file name trigram index
+    return Q(id__in=EmailAttachment.objects.filter(file_name__iregex=re.escape(value)).values('source_email_id'))
+
+def header(value: str) -> Q:
+    # header:<name>=<value> matches the value exactly, header:<name> emails that have the header
+    name, _, value = value.partition('=')
+    if value:
+        return Q(headers__contains={name.lower(): [unquote(value)]})
+    else:
+        return Q(headers__has_key=name.lower())
+
+operators = {'from': lambda value: Q(author_id__in=address_ids(value)),
+             'to': lambda value: recipients(Email.to, value),
+             'cc': lambda value: recipients(Email.cc, value),
+             'subject': subject,
+             'before': lambda value: Q(date__lt=parse_date(value)),
+             'after': lambda value: Q(date__gte=parse_date(value)),
+             'has': has,
+             'filename': filename,
+             'list': lambda value: Q(list_id__startswith=Email.normalize_list_id(value)),
+             'header': header}
+
+def parse_query(search_term: str) -> tuple:
+    # Returns the text part of the search term, and the condition compiled from the operators. Raises QueryError on invalid values
+    condition = Q()
+    for name, value in operator_pattern.findall(search_term):
+        value = value if name.lower() == 'header' else unquote(value)
+        condition &= operators[name.lower()](value)
+
+    return normalize_search_term(operator_pattern.sub(' ', search_term)), condition
@@ -0,0 +1,218 @@
+from django.core.exceptions import EmptyResultSet
+from django.db import connection
+from django.db.models import F, Q, Case, When, FloatField, OuterRef, Subquery, Value
+from django.db.models.functions import Cast, Coalesce, Greatest, Left, Lower
+from django.contrib.postgres.search import SearchHeadline, SearchQuery, SearchRank, TrigramWordDistance, TrigramWordSimilarity
+from searchix import settings
+from searchix.models import Email, EmailAddress, EmailAttachment, EmailBodyChunk, IndexGeneration
+from collections import OrderedDict
+import hashlib
+import json
+import re
+import threading
+
+# Fields with a trigram index (see models.Email), content_html is covered by content_text
+fuzzy_fields = ['subject', 'content_text']
+
+# Delimit the matches in headlines. Private use characters, so that the headline can be escaped before the matches are highlighted
+headline_start = '\ue000'
+headline_stop = '\ue001'
+
+
+class ResultCache:
+    # Caches the ids returned by search queries. Keys include the index generation, so cached results
+    # are invalidated as soon as the indexer commits new content (see IndexGeneration)
+    def __init__(self, max_size: int, backend: str = None):
+        self.max_size = max_size
+        self.backend = backend # Name of a cache in settings.CACHES, local LRU if None
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def make_key(self, queryset, *extra) -> str:
+        # The SQL of the query covers the search term, the filters and the pagination cursor
+        try:
+            sql, params = queryset.query.sql_with_params()
+        except EmptyResultSet:
+            sql, params = None, () # The query can't match anything (e.g. filtered on an empty list of ids), no SQL is generated
+        key = repr((IndexGeneration.current(), sql, params, extra))
+
+        return 'searchix-results-' + hashlib.sha256(key.encode()).hexdigest()
+
+    def get(self, key: str):
+        if self.backend is not None:
+            from django.core.cache import caches
+            return caches[self.backend].get(key)
+
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+
+            return value
+
+    def set(self, key: str, value):
+        if self.backend is not None:
+            from django.core.cache import caches
+            caches[self.backend].set(key, value)
+            return
+
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+result_cache = ResultCache(settings.SEARCH_CACHE_SIZE, settings.SEARCH_CACHE_BACKEND)
+
+def cached_results(queryset, limit: int) -> list:
+    key = result_cache.make_key(queryset, limit)
+    ids = result_cache.get(key)
+
+    if ids is None:
+        results = list(queryset[:limit])
+        result_cache.set(key, [e.id for e in results])
+        return results
+
+    # Only fetch the cached entries by primary key, in the cached order
+    entries = {e.id: e for e in queryset.order_by().filter(id__in=ids)}
+    return [entries[id] for id in ids if id in entries]
+
+def cached_ids(queryset) -> list:
+    key = result_cache.make_key(queryset)
+    ids = result_cache.get(key)
+
+    if ids is None:
+        ids = list(queryset)
+        result_cache.set(key, ids)
+
+    return ids
+
+def normalize_search_term(search_term: str) -> str:
+    return ' '.join(search_term.split())
+
+def text_query(search_term: str) -> SearchQuery:
+    return SearchQuery(search_term, search_type='websearch', config='english')
+
+def set_fuzzy_threshold():
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT set_config('pg_trgm.word_similarity_threshold', %s, false)", [str(settings.FUZZY_SEARCH_THRESHOLD)])
+
+def fuzzy_candidates(queryset, search_term: str) -> list:
+    # One query per field, each served by the field's trigram index ('%>' filter, '<<->' nearest neighbours ordering)
+    return [queryset.filter(**{f'{field}__trigram_word_similar': search_term})
+                    .order_by(TrigramWordDistance(search_term, field))
+                    .values_list('id', flat=True)[:settings.FUZZY_SEARCH_CANDIDATE_LIMIT]
+            for field in fuzzy_fields]
+
+# Content indexed outside of the email row: (relation from Email, model, field referencing the email, candidate limit)
+related_content = [('body_chunks', EmailBodyChunk, 'email', settings.CHUNK_SEARCH_CANDIDATE_LIMIT),
+                   ('emailattachment', EmailAttachment, 'source_email', settings.ATTACHMENT_SEARCH_CANDIDATE_LIMIT)]
+
+def related_candidates(queryset, query: SearchQuery, relation: str, limit: int):
+    # Emails of the best `limit` matching related entries, best matches first (may contain duplicates).
+    # Served by the related model's text index, and a top-N sort instead of grouping every match by email
+    return (queryset.filter(**{f'{relation}__search_vector': query})
+                    .annotate(related_rank=SearchRank(F(f'{relation}__search_vector'), query=query))
+                    .order_by('-related_rank')
+                    .values_list('id', flat=True)[:limit])
+
+def related_rank(query: SearchQuery, model, email_field: str):
+    # Rank of the best matching related entry of each email
+    entries = model.objects.filter(**{email_field: OuterRef('pk')}, search_vector=query).annotate(rank=SearchRank(F('search_vector'), query=query))
+    return Subquery(entries.order_by('-rank').values('rank')[:1])
+
+def search_emails(queryset, search_term: str, fuzzy: bool, truncated: list = None):
+    # Models whose related candidates were cut at their limit are appended to truncated, with the limit
+    query = text_query(search_term)
+    text_match = Q(search_vector=query)
+    rank = SearchRank(F('search_vector'), query=query)
+
+    # Like fuzzy candidates, related matches are fetched first so that the main query can combine the indexes
+    for relation, model, email_field, limit in related_content:
+        matches = cached_ids(related_candidates(queryset, query, relation, limit))
+        if truncated is not None and len(matches) >= limit:
+            truncated.append((model, limit))
+
+        candidates = list(dict.fromkeys(matches))
+        if candidates:
+            text_match |= Q(id__in=candidates)
+            rank = Greatest(rank, Case(When(id__in=candidates, then=related_rank(query, model, email_field)), default=Value(0.0), output_field=FloatField()))
+
+    # ts_rank() returns a real, cast to double precision so that the rank is returned exactly and can be used as a pagination cursor
+    rank = Cast(rank, output_field=FloatField())
+
+    if not fuzzy:
+        return queryset.filter(text_match).annotate(rank=rank)
+
+    set_fuzzy_threshold()
+
+    # Candidates are fetched first so that the main query can combine both indexes (bitmap OR) instead of scanning
+    candidates = {id for candidate_query in fuzzy_candidates(queryset, search_term) for id in cached_ids(candidate_query)}
+
+    # Fuzzy-only matches are ranked after text matches
+    similarity = Greatest(*[TrigramWordSimilarity(search_term, field) for field in fuzzy_fields]) - 1
+
+    return (queryset.filter(text_match | Q(id__in=candidates))
+                    .annotate(rank=Case(When(text_match, then=rank), default=similarity)))
+
+def add_headlines(entries: list, search_term: str):
+    # Highlighted snippets, generated by postgres (ts_headline) so that stemmed words and every term of the query are highlighted.
+    # Only computed for the entries of the current page, over a bounded prefix of the body
+    query = text_query(search_term)
+    content = Left(Coalesce('content_text', 'content_html'), settings.RESULT_PAGE_HEADLINE_CONTENT_SIZE)
+
+    headlines = (Email.objects.filter(id__in=[e.id for e in entries])
+                    .annotate(subject_headline=SearchHeadline('subject', query, config='english', start_sel=headline_start, stop_sel=headline_stop, highlight_all=True),
+                              content_headline=SearchHeadline(content, query, config='english', start_sel=headline_start, stop_sel=headline_stop,
+                                                              max_words=settings.RESULT_PAGE_HEADLINE_MAX_WORDS,
+                                                              min_words=settings.RESULT_PAGE_HEADLINE_MIN_WORDS,
+                                                              max_fragments=settings.RESULT_PAGE_HEADLINE_MAX_FRAGMENTS,
+                                                              fragment_delimiter=' ... '))
+                    .values_list('id', 'subject_headline', 'content_headline'))
+
+    headlines = {id: (subject, content) for id, subject, content in headlines}
+    for entry in entries:
+        entry.subject_headline, entry.content_headline = headlines.get(entry.id, (None, None))
+
+def match_addresses(queryset, value: str):
+    # Addresses starting with value (address_prefix_index), or with a similar address or display name (trigram indexes)
+    return (queryset.alias(lower_address=Lower('address'))
+                    .filter(Q(lower_address__startswith=value.lower()) | Q(address__trigram_similar=value) | Q(display_names__trigram_similar=value)))
+
+def address_ids(value: str) -> list:
+    # Resolved first, so that emails are then filtered on address ids instead of joining the address table
+    return cached_ids(match_addresses(EmailAddress.objects.all(), value).values_list('id', flat=True)[:settings.ADDRESS_FILTER_CANDIDATE_LIMIT])
+
+def autocomplete_addresses(prefix: str) -> list:
+    prefix = prefix.strip()
+    condition = Q(lower_address__startswith=prefix.lower())
+
+    # Trigram indexes can only serve patterns of at least 3 characters
+    if len(prefix) >= 3:
+        condition |= Q(display_names__iregex=f'(^|,)\\s*{re.escape(prefix)}')
+
+    return list(EmailAddress.objects.alias(lower_address=Lower('address')).filter(condition).only('id', 'address', 'display_names')[:settings.ADDRESS_AUTOCOMPLETE_LIMIT])
+
+def collapse_threads(queryset, ordering: list):
+    # Only keeps the first result of each thread, in a single query (DISTINCT ON served by the thread index).
+    # Emails that aren't assigned to a thread yet are all kept
+    first_results = queryset.order_by('thread_id', *ordering).distinct('thread_id').values('id')
+    return queryset.filter(Q(id__in=first_results) | Q(thread_id=None))
+
+def count_results(queryset, limit: int) -> int:
+    queryset = queryset.order_by()
+
+    key = result_cache.make_key(queryset, 'count', limit)
+    count = result_cache.get(key)
+
+    if count is None:
+        # Exact count up to limit, planner estimate above it (a search can match most of the table)
+        count = queryset[:limit + 1].count()
+        if count > limit:
+            plan = json.loads(queryset.explain(format='json'))
+            count = max(int(plan[0]['Plan']['Plan Rows']), limit + 1)
+
+        result_cache.set(key, count)
+
+    return count
@@ -137,5 +137,35 @@ RESULT_PAGE_MAX_EMAIL_SUJECT_SIZE = 40
 RESULT_PAGE_MAX_EMAIL_BODY_SIZE = 100
 
 RESULT_PAGE_SEARCH_MATCH_PADDING = 7
-
-MAX_EMAIL_CONTENT_SIZE = 10000 # postgres search index size limitation
+RESULT_PAGE_HEADLINE_CONTENT_SIZE = 5000 # Number of body characters searched for highlighted snippets
+RESULT_PAGE_HEADLINE_MAX_WORDS = 15
+RESULT_PAGE_HEADLINE_MIN_WORDS = 5
+RESULT_PAGE_HEADLINE_MAX_FRAGMENTS = 2
+
+SEARCH_RESULT_COUNT_LIMIT = 1000 # Results are counted exactly up to this limit, and estimated above
+SEARCH_CACHE_SIZE = 1000 # Number of search results (pages, counts) cached in memory
+SEARCH_CACHE_BACKEND = None # Name of a cache in CACHES to share cached results between processes, in memory if None
+THREAD_VIEW_MAX_SIZE = 100 # Maximum number of emails listed in the thread of an email
+
+HTML_CONVERSION_MAX_SIZE = 256 * 1024 # Bigger html bodies are converted to text by stripping the tags, which is much faster
+MAX_EMAIL_CONTENT_SIZE = 10000 # Size of each indexed chunk of an email body (postgres search index size limitation)
+MAX_EMAIL_BODY_CHUNKS = 100 # Bodies longer than MAX_EMAIL_CONTENT_SIZE * MAX_EMAIL_BODY_CHUNKS are truncated
+CHUNK_SEARCH_CANDIDATE_LIMIT = 1000 # Maximum number of matching chunks (past the first one of each email) included in search results
+ATTACHMENT_SEARCH_CANDIDATE_LIMIT = 1000 # Maximum number of matching attachments included in search results
+
+INDEX_BATCH_SIZE = 100 # Number of emails written per transaction while indexing
+ADDRESS_CACHE_SIZE = 100000 # Maximum number of email addresses cached by the indexer
+INDEX_PREFETCH_SIZE = 64 # Number of files read ahead of the parser while indexing
+
+# Where attachment payloads are stored. Set to None to store them inline in the database
+ATTACHMENT_STORAGE = 'searchix.storage.FileSystemStorage'
+ATTACHMENT_STORAGE_OPTIONS = {'root': BASE_DIR / 'attachments'}
+ATTACHMENT_DOWNLOAD_CHUNK_SIZE = 64 * 1024
+ATTACHMENT_EXTRACT_MAX_SIZE = 10 * 1024 * 1024 # Text isn't extracted from bigger attachments
+ATTACHMENT_TEXT_MAX_SIZE = 100000 # Maximum number of characters indexed per attachment
+
+ADDRESS_FILTER_CANDIDATE_LIMIT = 1000 # Maximum number of addresses matched by the author filter
+ADDRESS_AUTOCOMPLETE_LIMIT = 20
+
+FUZZY_SEARCH_THRESHOLD = 0.6 # Minimum word similarity for fuzzy matches (pg_trgm.word_similarity_threshold)
+FUZZY_SEARCH_CANDIDATE_LIMIT = 200 # Maximum number of fuzzy matches per field
@@ -0,0 +1,119 @@
+from searchix import settings
+from django.db.models import F
+from django.utils.module_loading import import_string
+
+import functools
+import hashlib
+import os
+import tempfile
+
+
+class AttachmentStorage:
+    # Content-addressed storage for attachment payloads. Keys are sha256 hashes of the content
+    def exists(self, key: str) -> bool:
+        raise NotImplementedError()
+
+    def save(self, key: str, content: bytes):
+        raise NotImplementedError()
+
+    def open(self, key: str):
+        raise NotImplementedError()
+
+    def delete(self, key: str):
+        raise NotImplementedError()
+
+    def keys(self):
+        raise NotImplementedError()
+
+class FileSystemStorage(AttachmentStorage):
+    def __init__(self, root: str):
+        self.root = str(root)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key[2:4], key)
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self.path(key))
+
+    def save(self, key: str, content: bytes):
+        path = self.path(key)
+        if os.path.exists(path):
+            return
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to a temporary file first so that a partially written blob is never visible
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(content)
+
+            os.replace(temp_path, path)
+        except:
+            os.unlink(temp_path)
+            raise
+
+    def open(self, key: str):
+        return open(self.path(key), 'rb')
+
+    def delete(self, key: str):
+        try:
+            os.unlink(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def keys(self):
+        for folder, _, files in os.walk(self.root):
+            for name in files:
+                # Skips temporary files (see save())
+                if self.path(name) == os.path.join(folder, name):
+                    yield name
+
+@functools.cache
+def get_storage() -> AttachmentStorage:
+    # Returns None if attachments are stored inline in the database
+    if settings.ATTACHMENT_STORAGE is None:
+        return None
+
+    return import_string(settings.ATTACHMENT_STORAGE)(**settings.ATTACHMENT_STORAGE_OPTIONS)
+
+def hash_content(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+def store_attachments(attachments: list):
+    # Saves the payloads to the storage backend and points the attachments to their (deduplicated) blob.
+    # The attachments' content is left untouched so that this can be retried if the transaction fails.
+    # Payloads are written before the transaction commits, so blobs of rolled back transactions are left without a row (see the attachments cleanup command)
+    from searchix.models import AttachmentBlob
+
+    storage = get_storage()
+    hashes = {}
+    references = {}
+    sizes = {}
+
+    for attachment in attachments:
+        if attachment.content is None:
+            continue
+
+        key = hash_content(attachment.content)
+        storage.save(key, attachment.content)
+
+        hashes[id(attachment)] = key
+        references[key] = references.get(key, 0) + 1
+        sizes[key] = len(attachment.content)
+
+    if not references:
+        return
+
+    AttachmentBlob.objects.bulk_create([AttachmentBlob(hash=key, size=size) for key, size in sizes.items()], ignore_conflicts=True)
+
+    # Lock the blobs in a consistent order so that concurrent indexing processes can't deadlock
+    ids = dict(AttachmentBlob.objects.select_for_update().filter(hash__in=references.keys()).order_by('hash').values_list('hash', 'id'))
+
+    for count in set(references.values()):
+        AttachmentBlob.objects.filter(hash__in=[key for key, value in references.items() if value == count]).update(references=F('references') + count)
+
+    for attachment in attachments:
+        key = hashes.get(id(attachment))
+        if key is not None:
+            attachment.blob_id = ids[key]
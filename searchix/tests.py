@@ -0,0 +1,86 @@
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import TestCase
+from searchix.models import Email
+import datetime
+import urllib.parse
+
+
+class PlanTest(TestCase):
+    # Checks search plans with explain_search. Sequential scans are disabled (--force-index), since they're preferred on tables this small
+
+    @classmethod
+    def setUpTestData(cls):
+        for day in range(1, 29):
+            Email.objects.create(message_id=f'<{day}@example.org>', original_path=f'/test/{day}.eml', subject=f'Release {day}', content_text='Release notes', date=datetime.date(2024, 2, day))
+
+    def tearDown(self):
+        with connection.cursor() as cursor:
+            cursor.execute('RESET enable_seqscan')
+
+    def explain(self, search_term: str, **options):
+        call_command('explain_search', search_term, force_index=True, **options)
+
+class DateRangePlanTest(PlanTest):
+    def test_date_range(self):
+        self.explain('after:2024-02-10 before:2024-02-20', expect_index=['date_index'])
+
+    def test_date_range_search(self):
+        self.explain('after:2024-02-10 before:2024-02-20 release')
+
+    def test_unused_index(self):
+        with self.assertRaises(CommandError):
+            self.explain('release', expect_index=['missing_index'])
+
+class FuzzyPlanTest(PlanTest):
+    def test_fuzzy_search(self):
+        self.explain('relase', fuzzy=True, expect_index=['subject_index', 'text_trigram_index'])
+
+class ChangeListTest(TestCase):
+    # Renders the email results page, with the parameters set by the search box, the filters and the pagination links
+
+    @classmethod
+    def setUpTestData(cls):
+        for id in range(1, 102):
+            Email.objects.create(message_id=f'<{id}@example.org>', original_path=f'/test/{id}.eml', subject=f'Release {id}', content_text='Release notes', date=datetime.date(2024, 2, 1 + id % 28))
+
+    def get(self, **params):
+        response = self.client.get('/searchix/email/', params)
+        self.assertEqual(response.status_code, 200)
+
+        return response
+
+    def next_page(self, response) -> dict:
+        # Parameters of the next page link
+        self.assertIsNotNone(response.context['cl'].next_page_url)
+        return dict(urllib.parse.parse_qsl(response.context['cl'].next_page_url.lstrip('?')))
+
+    def test_list(self):
+        response = self.get()
+        self.get(**self.next_page(response))
+
+    def test_search(self):
+        response = self.get(q='release')
+        self.assertContains(response, 'Release')
+
+        self.get(**self.next_page(response))
+
+    def test_operators(self):
+        self.get(q='after:2024-02-10 before:2024-02-20')
+        self.get(q='after:2024-02-10 release')
+
+    def test_fuzzy(self):
+        self.get(q='relase', fuzzy='disable')
+
+    def test_threads(self):
+        self.get(threads='collapse')
+        self.get(q='release', threads='collapse')
+
+    def test_filters(self):
+        self.get(after='2024-02-10', before='2024-02-20', q='release')
+        self.get(address='alice')
+
+    def test_invalid_cursor(self):
+        # Invalid lookups redirect to the unfiltered list
+        self.assertEqual(self.client.get('/searchix/email/', {'q': 'release', 'cursor': 'invalid'}).status_code, 302)
@@ -2,9 +2,10 @@ from . import models
 from django.urls import path, re_path, include
 from django.contrib import admin
 from django.contrib.staticfiles import views
-from .views import attachment
+from .views import address, attachment
 
 urlpatterns = [
     path('download/attachment/<int:id>/', attachment.attachment_download),
+    path('autocomplete/address/', address.address_autocomplete),
     path('', admin.site.urls),
 ]
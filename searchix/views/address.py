@@ -0,0 +1,11 @@
+from django.http import JsonResponse
+from searchix.search import autocomplete_addresses
+
+
+def address_autocomplete(request):
+    prefix = request.GET.get('q', '')
+    if not prefix.strip():
+        return JsonResponse({'results': []})
+
+    results = [{'id': e.id, 'address': e.address, 'names': e.names(), 'text': e.to_string()} for e in autocomplete_addresses(prefix)]
+    return JsonResponse({'results': results})
@@ -1,16 +1,106 @@
-from django.http import HttpResponse, HttpResponseNotFound
+from django.http import HttpResponse, HttpResponseNotFound, StreamingHttpResponse
+from django.db.models import F, Value, Func, BinaryField, BigIntegerField
+from django.utils.cache import get_conditional_response
+from django.utils.http import content_disposition_header, http_date, quote_etag, parse_etags
 from searchix.models import EmailAttachment
+from searchix import settings
+import re
+
+range_pattern = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def read_file(fd, start: int, length: int):
+    with fd:
+        fd.seek(start)
+        while length > 0:
+            chunk = fd.read(min(length, settings.ATTACHMENT_DOWNLOAD_CHUNK_SIZE))
+            if not chunk:
+                break
+
+            length -= len(chunk)
+            yield chunk
+
+def read_inline(id: int, start: int, length: int):
+    # Inline attachments are read chunk by chunk so that the whole content is never loaded in memory
+    end = start + length
+    while start < end:
+        size = min(end - start, settings.ATTACHMENT_DOWNLOAD_CHUNK_SIZE)
+        chunk = Func(F('content'), Value(start + 1), Value(size), function='substring', output_field=BinaryField())
+        yield bytes(EmailAttachment.objects.filter(id=id).annotate(chunk=chunk).values_list('chunk', flat=True).get())
+
+        start += size
+
+def parse_range(header: str, size: int) -> tuple:
+    # Returns (start, length), None if the whole content should be sent or False if the range can't be satisfied.
+    # Only single ranges are supported, multiple ranges are answered with the whole content
+    match = range_pattern.match(header.replace(' ', ''))
+    if match is None:
+        return None
+
+    start, end = match.groups()
+    if not start and not end:
+        return None
+    elif not start:
+        # Suffix range: last <end> bytes
+        length = min(int(end), size)
+        return (size - length, length) if length > 0 else False
+
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start >= size or end < start:
+        return False
+
+    return start, end - start + 1
 
 def attachment_download(request, id):
 
     try:
-        attachment = EmailAttachment.objects.get(id=id)
+        size = Func(F('content'), function='octet_length', output_field=BigIntegerField())
+        attachment = EmailAttachment.objects.select_related('blob').defer('content').annotate(inline_size=size).get(id=id)
     except EmailAttachment.DoesNotExist:
         return HttpResponseNotFound()
 
-    # TODO: This won't work for big files
-    response = HttpResponse(attachment.content, content_type=attachment.content_type)
+    if attachment.blob is not None:
+        size = attachment.blob.size
+        etag = quote_etag(attachment.blob.hash)
+    else:
+        size = attachment.inline_size or 0
+        etag = quote_etag(f'attachment-{attachment.id}') # Attachments are never modified once indexed
+
+    last_modified = int(attachment.created_timestamp.timestamp())
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        return response
+
+    start, length = 0, size
+    status = 200
+
+    content_range = request.headers.get('Range')
+    if_range = request.headers.get('If-Range')
+    if content_range and (not if_range or etag in parse_etags(if_range)):
+        requested = parse_range(content_range, size)
+        if requested is False:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
+        elif requested is not None:
+            start, length = requested
+            status = 206
+
+    if attachment.blob is not None:
+        content = read_file(attachment.open_content(), start, length)
+    else:
+        content = read_inline(attachment.id, start, length)
+
+    response = StreamingHttpResponse(content, status=status, content_type=attachment.content_type or 'application/octet-stream')
+    response['Content-Length'] = str(length)
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    response['Content-Disposition'] = content_disposition_header(False, attachment.file_name or 'unnamed')
 
-    response['Content-Disposition'] = 'inline; filename=' + attachment.file_name or 'unnamed'
+    if status == 206:
+        response['Content-Range'] = f'bytes {start}-{start + length - 1}/{size}'
 
     return response